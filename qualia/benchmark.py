@@ -0,0 +1,352 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+# These are small benchmarks for the parts of Qualia that have been tuned for speed or memory use,
+# so the numbers behind those changes can be reproduced. Each one works in a temporary database (or
+# journal), and is run with:
+#
+#> python -m qualia.benchmark <benchmark> [options]
+#
+## Imports
+from . import config, database, journal
+from .lazy_import import lazy_import
+
+import argparse
+import sys
+
+lazy_import(globals(), """
+	import datetime
+	import multiprocessing
+	import os
+	from os import path
+	import pickle
+	import resource
+	import tempfile
+	import time
+""")
+
+## Utility functions
+# Sets up the configuration the same way `qualia.main` does when there is no config file, with the
+# given overrides.
+def _load_config(**overrides):
+	config.conf = config.load_value({}, config.CONF_BASE)
+	config.conf.update(overrides)
+
+# Returns the peak resident set size of this process, in megabytes.
+def _peak_rss():
+	# (Linux reports this in kilobytes.)
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+## Benchmarks
+### `take`
+# Moves a file of the given size (in megabytes) into a new database in the same directory (so it's
+# simply renamed into place), returning the time it took and the peak memory use of the process
+# before and after. This is run in a fresh process for each size, so the peaks don't carry over.
+def _take_once(size, directory):
+	_load_config()
+
+	db_path = tempfile.mkdtemp(dir = directory)
+	db = database.Database(path.join(db_path, 'db'))
+
+	source_filename = path.join(db_path, 'source')
+	chunk = os.urandom(database.CHUNK_SIZE)
+
+	with open(source_filename, 'wb') as f:
+		for _ in range(size * 1024 * 1024 // len(chunk)):
+			f.write(chunk)
+
+	rss_before = _peak_rss()
+
+	start = time.perf_counter()
+	with open(source_filename, 'rb') as source_file:
+		db.add_file(source_file, move = True)
+	db.commit()
+	elapsed = time.perf_counter() - start
+
+	db.close()
+
+	return elapsed, rss_before, _peak_rss()
+
+# Taking a file should use the same amount of memory no matter how large it is.
+def benchmark_take(args):
+	context = multiprocessing.get_context('spawn')
+
+	with tempfile.TemporaryDirectory(dir = args.directory) as directory:
+		for size in args.sizes:
+			with context.Pool(1) as pool:
+				elapsed, rss_before, rss_after = pool.apply(_take_once, (size, directory))
+
+			print('{} MB: {:.2f}s, peak RSS {:.1f} MB before, {:.1f} MB after'.format(size, elapsed, rss_before, rss_after))
+
+### `extra`
+# Typical extra arguments for each kind of transaction: none for an `add` or `delete`, and the field
+# name, old value and new value for a `set`.
+def _sample_extras():
+	now = datetime.datetime.now()
+
+	return [
+		(),
+		('filename', None, '/home/user/Pictures/2015/IMG_{:04d}.jpg'),
+		('imported-at', None, now),
+		('file-modified-at', now - datetime.timedelta(days = 3), now),
+		('tags', 'holiday', 'holiday beach'),
+		('comments', None, None),
+		('image.width', None, 4032),
+	]
+
+# Returns how many seconds each call of `func` takes on average, over `count` calls with each of
+# `values`. Like `timeit`, this takes the best of a few runs, as anything else running at the same
+# time can only make it slower.
+def _time_each(func, values, count, repeat = 5):
+	best = None
+
+	for _ in range(repeat):
+		start = time.perf_counter()
+
+		for _ in range(count):
+			for value in values:
+				func(value)
+
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best: best = elapsed
+
+	return best / (count * len(values))
+
+# Writes `count` copies of each sample transaction to a new journal in `directory`, either in typed
+# columns as usual or pickled into `extra` (as they were before), and returns the journal's size in
+# bytes and the time it takes to read every transaction back, in seconds per transaction.
+def _extra_journal(directory, extras, count, pickled):
+	filename = path.join(tempfile.mkdtemp(dir = directory), 'journal')
+	j = journal.Journal(filename)
+	now = datetime.datetime.now()
+	hash = '0' * 128
+
+	if pickled:
+		columns = 'extra'
+		encode = lambda extra: (pickle.dumps(extra),)
+	else:
+		columns = 'field, old_value, new_value, value_types'
+		encode = journal._encode_extra
+
+	with j.db:
+		j.db.executemany(
+			'INSERT INTO journal(timestamp, source, file, op, {}) VALUES(?, ?, ?, ?, {})'.format(
+				columns,
+				', '.join('?' * (columns.count(',') + 1)),
+			),
+			(
+				(now, 'auto', hash, 'set' if extra else 'add') + encode(extra)
+				for _ in range(count)
+				for extra in extras
+			)
+		)
+
+	j.db.execute('VACUUM')
+	size = os.stat(filename).st_size
+
+	read = lambda _: [journal._transaction(row) for row in j.db.execute('SELECT * FROM journal')]
+	elapsed = _time_each(read, [None], 1)
+	j.db.close()
+
+	return size, elapsed / (count * len(extras))
+
+# Compares storing the journal's extra arguments in typed columns with pickling them, as it was done
+# before.
+def benchmark_extra(args):
+	extras = _sample_extras()
+
+	with tempfile.TemporaryDirectory(dir = args.directory) as directory:
+		for name, pickled in [('columns', False), ('pickled', True)]:
+			size, elapsed = _extra_journal(directory, extras, args.count, pickled)
+
+			print('{}: {:.2f}us to read each transaction, {:.1f} bytes each on disk'.format(
+				name,
+				elapsed * 1e6,
+				size / (args.count * len(extras)),
+			))
+
+### `append`
+# Appends `set`s of `fields` fields for each of `files` files to a new journal, committing after
+# every `files_per_commit` files, and returns how many were appended per second.
+def _append_rate(directory, files, fields, files_per_commit):
+	j = journal.Journal(path.join(tempfile.mkdtemp(dir = directory), 'journal'))
+	start = time.perf_counter()
+
+	for i in range(files):
+		hash = '{:0128x}'.format(i)
+
+		for field in range(fields):
+			j.append('auto', hash, 'set', 'field-{}'.format(field), None, 'value {}'.format(i))
+
+		if (i + 1) % files_per_commit == 0: j.commit()
+
+	j.commit()
+	elapsed = time.perf_counter() - start
+	j.db.close()
+
+	return files * fields / elapsed
+
+# Measures how quickly transactions can be appended to the journal with each of the given
+# `journal-synchronous` settings, both buffered as usual and written out one at a time (as they were
+# before `Journal.append` buffered them).
+def benchmark_append(args):
+	with tempfile.TemporaryDirectory(dir = args.directory) as directory:
+		for synchronous in args.synchronous:
+			_load_config(**{'journal-synchronous': synchronous})
+
+			for name, buffer_size in [('buffered', journal.APPEND_BUFFER_SIZE), ('unbuffered', 1)]:
+				default_buffer_size, journal.APPEND_BUFFER_SIZE = journal.APPEND_BUFFER_SIZE, buffer_size
+
+				try:
+					rate = _append_rate(directory, args.files, args.fields, args.files_per_commit)
+				finally:
+					journal.APPEND_BUFFER_SIZE = default_buffer_size
+
+				print('synchronous = {}, {}: {:.0f} appends/s'.format(synchronous, name, rate))
+
+### `search`
+# Runs each of the given queries `count` times against a new database of `files` files, after the
+# first commit, and reports how long each query took on average along with how often the searcher
+# was reused and the parsed query was found in the cache. (These counts only cover this process, so
+# `qualia stats` can't show them.)
+def benchmark_search(args):
+	_load_config()
+
+	with tempfile.TemporaryDirectory(dir = args.directory) as directory:
+		db = database.Database(path.join(directory, 'db'))
+
+		for i in range(args.files):
+			source_filename = path.join(directory, 'source')
+
+			with open(source_filename, 'w') as source_file:
+				source_file.write('file {}\n'.format(i))
+
+			with open(source_filename, 'rb') as source_file:
+				f = db.add_file(source_file)
+
+			f.set_metadata('tags', 'even' if i % 2 == 0 else 'odd')
+			db.save(f)
+
+		db.commit()
+
+		try:
+			print('{:.1f}us per query'.format(_time_each(db.searchdb.count, args.queries, args.count, repeat = 1) * 1e6))
+		finally:
+			searcher_stats, query_cache_stats = db.searchdb.searcher_stats, db.searchdb.query_cache_stats
+			db.close()
+
+	print('searchers: {} opened, {} reused'.format(searcher_stats['opened'], searcher_stats['reused']))
+	print('query cache: {} hits, {} misses'.format(query_cache_stats['hits'], query_cache_stats['misses']))
+
+## Main function
+def main():
+	parser = argparse.ArgumentParser(prog = 'python -m qualia.benchmark')
+
+	subparsers = parser.add_subparsers(
+		title = 'benchmarks',
+		dest = 'benchmark',
+		metavar = '<benchmark>',
+	)
+
+	p = subparsers.add_parser(
+		'take',
+		help = 'Measure the peak memory use of taking files of different sizes',
+	)
+	p.add_argument('sizes',
+		help = 'Sizes of the files to take, in megabytes',
+		nargs = '*',
+		type = int,
+		default = [16, 256, 1024],
+	)
+	p.add_argument('--directory',
+		help = 'Where to create the files and databases (default: the temporary directory)',
+	)
+
+	p = subparsers.add_parser(
+		'extra',
+		help = 'Compare storing journal extra arguments in columns with pickling them',
+	)
+	p.add_argument('--count', '-n',
+		help = 'Number of copies of each sample transaction to write and read back',
+		type = int,
+		default = 20000,
+	)
+	p.add_argument('--directory',
+		help = 'Where to create the journals (default: the temporary directory)',
+	)
+
+	p = subparsers.add_parser(
+		'append',
+		help = 'Measure how quickly transactions are appended to the journal',
+	)
+	p.add_argument('synchronous',
+		help = 'Values of the `journal-synchronous` option to try (off, normal, full or extra)',
+		nargs = '*',
+		default = ['full', 'normal'],
+	)
+	p.add_argument('--files',
+		help = 'Number of files to add metadata for',
+		type = int,
+		default = 10000,
+	)
+	p.add_argument('--fields',
+		help = 'Number of fields set for each file',
+		type = int,
+		default = 10,
+	)
+	p.add_argument('--files-per-commit',
+		help = 'Number of files in each checkpoint',
+		type = int,
+		default = 1000,
+	)
+	p.add_argument('--directory',
+		help = 'Where to create the journals (default: the temporary directory)',
+	)
+
+	p = subparsers.add_parser(
+		'search',
+		help = 'Measure how quickly searches are run against the same database',
+	)
+	p.add_argument('queries',
+		help = 'Queries to run',
+		nargs = '*',
+		default = ['tags:even', 'tags:odd', 'tags:even OR tags:odd'],
+	)
+	p.add_argument('--count', '-n',
+		help = 'Number of times to run each query',
+		type = int,
+		default = 1000,
+	)
+	p.add_argument('--files',
+		help = 'Number of files in the database',
+		type = int,
+		default = 1000,
+	)
+	p.add_argument('--directory',
+		help = 'Where to create the database (default: the temporary directory)',
+	)
+
+	args = parser.parse_args()
+
+	if args.benchmark is None:
+		parser.print_help()
+		return 1
+
+	return globals()['benchmark_' + args.benchmark.replace('-', '_')](args) or 0
+
+if __name__ == '__main__':
+	sys.exit(main())
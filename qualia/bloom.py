@@ -0,0 +1,172 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+# This is a Bloom filter over the hashes of every file in the database, which lets
+# `Database.exists` answer "no" (the common case when adding new files) without looking anything up
+# in the hash index.
+#
+# The filter is a header followed by a bit array, which is memory-mapped and updated in place. As
+# hashes are already uniformly distributed, the bit positions for each are taken straight from its
+# first 16 bytes (using double hashing) rather than hashing it again.
+#
+# A Bloom filter can't forget anything, so deleted files are only counted; once enough have been
+# deleted (or too many files have been added for the filter's size), it's rebuilt at the next commit.
+# Like the hash index, it records the generation of the search index it matches, and is rebuilt if
+# that doesn't match when it's opened.
+#
+## Imports
+from .lazy_import import lazy_import
+
+lazy_import(globals(), """
+	import math
+	import mmap
+	import os
+	import struct
+""")
+
+## Constants
+# The header is this magic number, then the size of the filter in bits, the number of hashes added
+# and deleted since it was built, and the generation.
+MAGIC = b'QBF1'
+HEADER = struct.Struct('<4sQQQQ')
+
+# These give a false-positive rate of just under 1% when the filter is full.
+BITS_PER_HASH = 10
+NUM_PROBES = 7
+
+# New filters have room for at least this many hashes.
+MIN_CAPACITY = 1024
+
+## Bloom filter
+class BloomFilter:
+	def __init__(self, filename, read_only = False):
+		self.filename = filename
+		self.read_only = read_only
+
+		self.map = None
+		self.bits = None
+		self.size = 0
+		self.added = 0
+		self.deleted = 0
+		self.generation = None
+
+		try:
+			with open(filename, 'rb' if read_only else 'r+b') as f:
+				self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE)
+		except FileNotFoundError:
+			return
+
+		magic, size, added, deleted, generation = HEADER.unpack_from(self.map)
+
+		if magic != MAGIC or len(self.map) != HEADER.size + size // 8:
+			self.map = None
+			return
+
+		self.bits = memoryview(self.map)[HEADER.size:]
+		self.size, self.added, self.deleted, self.generation = size, added, deleted, generation
+
+	# Whether this filter matches the given generation of the search index.
+	def is_current(self, generation):
+		return self.generation == generation
+
+	# The number of hashes the filter can hold before it needs to be rebuilt larger.
+	@property
+	def capacity(self):
+		return self.size // BITS_PER_HASH
+
+	def _positions(self, hash):
+		key = bytes.fromhex(hash)
+		a, b = int.from_bytes(key[:8], 'little'), int.from_bytes(key[8:16], 'little') | 1
+
+		return ((a + i * b) % self.size for i in range(NUM_PROBES))
+
+	def __contains__(self, hash):
+		# An empty or missing filter can't rule anything out.
+		if self.bits is None: return True
+
+		try:
+			return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(hash))
+		except ValueError:
+			return False
+
+	def add(self, hash):
+		if self.bits is None: return
+
+		for position in self._positions(hash):
+			self.bits[position >> 3] |= 1 << (position & 7)
+
+		self.added += 1
+
+	def delete(self, hash):
+		self.deleted += 1
+
+	# Whether the filter has filled up or has too many deleted hashes in it, and should be rebuilt.
+	@property
+	def needs_rebuild(self):
+		return self.bits is None or self.added > self.capacity or self.deleted > self.added // 2
+
+	# Replaces the filter with a new one containing the given hashes (of which there are `count`),
+	# with room for twice as many. In read-only mode, the new filter is only kept in memory.
+	def rebuild(self, hashes, count, generation):
+		size = max(count * 2, MIN_CAPACITY) * BITS_PER_HASH
+		# Round up to a whole number of 64-bit words.
+		size = (size + 63) // 64 * 64
+
+		contents = bytearray(HEADER.size + size // 8)
+		self.map, self.bits = None, memoryview(contents)[HEADER.size:]
+		self.size, self.added, self.deleted, self.generation = size, 0, 0, generation
+
+		for hash in hashes: self.add(hash)
+
+		if self.read_only: return
+
+		HEADER.pack_into(contents, 0, MAGIC, self.size, self.added, self.deleted, self.generation)
+		new_filename = self.filename + '.new'
+
+		try:
+			with open(new_filename, 'wb') as f:
+				f.write(contents)
+				f.flush()
+				os.fsync(f.fileno())
+		except:
+			os.unlink(new_filename)
+			raise
+
+		os.replace(new_filename, self.filename)
+
+		with open(self.filename, 'r+b') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_WRITE)
+
+		self.bits = memoryview(self.map)[HEADER.size:]
+
+	# Flushes the filter to disk, recording that it now matches the given generation of the search
+	# index. The header is written last, so the filter is rebuilt if this is interrupted.
+	def commit(self, generation):
+		if self.read_only or self.map is None: return
+
+		self.map.flush()
+		self.generation = generation
+		HEADER.pack_into(self.map, 0, MAGIC, self.size, self.added, self.deleted, self.generation)
+		self.map.flush()
+
+	# Returns the fraction of bits that are set, and the false-positive rate that gives.
+	def stats(self):
+		if self.bits is None: return 0.0, 1.0
+
+		fill = bin(int.from_bytes(self.bits, 'little')).count('1') / self.size
+
+		return fill, math.pow(fill, NUM_PROBES)
@@ -28,6 +28,10 @@ class AmbiguousHashError(Exception):
 class CheckpointDoesNotExistError(Exception):
 	pass
 
+# The checkpoint is from before the point the journal was compacted to, so it can't be undone.
+class CheckpointCompactedError(Exception):
+	pass
+
 class DatabaseReadOnlyError(Exception):
 	pass
 
@@ -52,5 +56,14 @@ class FieldDoesNotExistError(Exception):
 class InvalidFieldValue(Exception):
 	pass
 
+# The cursor given to continue a search is malformed, or is from an earlier version of the search
+# index (which may have changed since) or a search in a different order.
+class InvalidCursorError(Exception):
+	pass
+
+# A migration to a different target was asked for while another is still unfinished.
+class MigrationInProgressError(Exception):
+	pass
+
 class UndoFailedError(Exception):
 	pass
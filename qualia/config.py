@@ -234,6 +234,10 @@ class NoVerifyItem(Item):
 		pass
 
 ## Default config hierarchies
+# These are the hash schemes that can be used to name stored files; see
+# `qualia.database.HASH_CONSTRUCTORS`.
+HASH_SCHEMES = ['sha512', 'sha256', 'blake2b-256', 'blake2b-512']
+
 # This is the base used for all of the `DerivedDictItem`s defined for the default metadata fields.
 FIELD_ITEM_BASE = DictItem(
 	'type', Item(set(['exact-text', 'text', 'id', 'number', 'keyword', 'datetime']), 'text'),
@@ -254,12 +258,51 @@ FIELD_ITEM_BASE = DictItem(
 CONF_BASE = DictItem(
 	'database-path', PathItem(None),
 	'fields', NoVerifyItem({}),
+	# This is only used when creating a new database; use `qualia migrate-hash` to change the hash
+	# scheme of an existing one.
+	'hash-scheme', Item(set(HASH_SCHEMES), 'sha512'),
+	# Likewise, this is only used for new databases; see `qualia migrate-layout`.
+	'layout-depth', Item(int, 1),
+	# Files smaller than this many bytes are stored in pack files rather than on their own (`0`
+	# turns this off).
+	'pack-threshold', Item(int, 0),
+	# Newly stored files are compressed with this (`'zlib'` or `'lzma'`) when it saves space.
+	'compression', Item(set(['none', 'zlib', 'lzma']), 'none'),
+	# Packed and compressed files are copied out into the database's `cache/` directory when a
+	# filename is needed for them (for instance, by `qualia search -f filename`). The least recently
+	# used copies are removed once there are more than this many megabytes of them.
+	'cache-size', Item(int, 1024),
+	# Which segments of the search index are merged at each commit: `'small'` ones, `'none'` (leaving
+	# it to `qualia maintenance optimize`), or everything (`'full'`).
+	'search-merge-policy', Item(set(['small', 'none', 'full']), 'small'),
+	# Changes to the search index are held in memory until they're committed, unless they take up
+	# more than roughly this many megabytes, in which case they're written out early.
+	'search-writer-memory', Item(int, 256),
+	# How carefully the journal is written to disk (SQLite's `synchronous` setting). `'normal'` is
+	# faster, but the last few checkpoints may be lost (though not corrupted) if the system crashes.
+	'journal-synchronous', Item(set(['off', 'normal', 'full', 'extra']), 'full'),
+	# How much of the journal SQLite caches in memory, in kilobytes.
+	'journal-cache-size', Item(int, 2048),
+	# How much of the journal SQLite reads through a memory map, in megabytes (`0` turns this off).
+	'journal-mmap-size', Item(int, 0),
 )
 
 # This base, on the other hand, is for the database state file, which is not intended to be edited
 # by the user.
 DB_STATE_BASE = DictItem(
 	'version', Item(int, None),
+	'hash-scheme', Item(set(HASH_SCHEMES), 'sha512'),
+	# The hash scheme an unfinished `qualia migrate-hash` is switching to; see
+	# `qualia.database.Database.migrate_hash`.
+	'hash-migration', Item(set(HASH_SCHEMES), None),
+	# This is how many directories deep stored files are nested, and (while a migration to a
+	# different depth is unfinished) the depth they are being moved from.
+	'layout', DictItem(
+		'depth', Item(int, 1),
+		'previous-depth', Item(int, None),
+	),
+	# The journal serial up to which deleted files have been removed by `qualia gc`.
+	'gc-serial', Item(int, 0),
 	# There is a complicated song and dance done in `qualia.database` to make sure that any
 	# modifications the user has done to the metadata fields in their global config file are applied
 	# to the fields configuration but not saved back to the state file.
@@ -20,9 +20,11 @@
 #
 ##Imports
 from .lazy_import import lazy_import
-from . import common, config
+from . import common, config, database
 
 lazy_import(globals(), """
+	import collections
+	from concurrent import futures
 	import datetime
 	import io
 	import os
@@ -30,7 +32,9 @@ lazy_import(globals(), """
 	import parsedatetime
 	import pickle
 	import pkg_resources
+	from qualia.plugins import magic as magic_plugin
 	import re
+	import shutil
 	import stat
 	import textwrap
 	import time
@@ -194,7 +198,7 @@ def export(db, output_file, hashes, *, metadata_only = False):
 	output_file = output_file or open(datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S.qualia'), 'wb')
 
 	# Note: we do this early and with a list so we catch all missing/ambiguous hashes early.
-	files = db.all() if hashes is None else [db.get(hash) for hash in hashes]
+	files = db.all() if hashes is None else db.get_many(hashes)
 
 	with zipfile.ZipFile(file = output_file, mode = 'w', compression = zipfile.ZIP_DEFLATED, allowZip64 = True) as out:
 		# We make sure to use the same timestamp for all operations, for consistency.
@@ -220,7 +224,13 @@ def export(db, output_file, hashes, *, metadata_only = False):
 			metadata_out.write(format_yaml_metadata(f))
 
 			if not metadata_only:
-				out.write(db.get_filename(f), 'files/' + f.hash)
+				# Files are read through `Database.open`, so that packed files don't have to be
+				# copied out first.
+				info = zipfile.ZipInfo('files/' + f.hash, timestamp)
+				info.compress_type = zipfile.ZIP_DEFLATED
+
+				with db.open(f) as source, out.open(info, 'w', force_zip64 = True) as dest:
+					shutil.copyfileobj(source, dest)
 
 		metadata_out.flush()
 		info = zipfile.ZipInfo('metadata.yaml', timestamp)
@@ -247,7 +257,9 @@ def import_(db, input_file, *, renames = {}, trust_hash = False):
 			elif info.filename.startswith('files/') and info.filename[-1] != '/':
 				try:
 					f = db.add_file(zipf.open(info))
-					for key, value in metadata.get(f.hash, {}).items():
+					# The metadata is stored under the hash the file had in the exporting database,
+					# which may not use the same hash scheme as this one.
+					for key, value in metadata.get(info.filename[len('files/'):], {}).items():
 						f.set_metadata(renames.get(key, key), value)
 					db.save(f)
 					print('imported {}'.format(f.short_hash))
@@ -280,3 +292,65 @@ def auto_add_metadata(f, original_filename):
 	f.set_metadata('file-modified-at', datetime.datetime.fromtimestamp(s.st_mtime), 'auto')
 
 	for importer in importers: importer(f, original_filename)
+
+# Returns the MIME type of the given file, as the `magic` importer would find it, without running
+# any of the other importers.
+def detect_mime_type(filename):
+	return magic_plugin.detect_mime_type(filename)
+
+## Bulk adding
+# This does the expensive part of adding a set of files (hashing, copying into the object store,
+# running the automatic metadata importers and compressing) on a pool of `jobs` worker threads, and
+# yields `(source_file, staged, f)` for each file in the original order. Nothing here touches the
+# journal or search index; the caller should pass each result through `Database.add_staged` and
+# `Database.save`, so all of those writes still happen on one thread.
+#
+# If a file can't be staged (for instance, if `link` asks for a kind of link its filesystem doesn't
+# support), the `OSError` is yielded in place of `staged` (with `f` as `None`), so the rest of the
+# files can still be added.
+#
+# Threads are enough to keep several cores busy, as hashlib, file I/O and libmagic all release the
+# GIL while they work.
+def stage_files(db, source_files, *, move = False, jobs = 1, link = 'auto'):
+	if importers is None:
+		_load_importers()
+
+	def _stage(source_file):
+		try:
+			staged = db.stage_file(source_file, move, link)
+		except OSError as e:
+			return source_file, e, None
+
+		try:
+			f = database.File(db, staged.hash, {})
+			auto_add_metadata(f, source_file.name)
+			db.compress_staged(staged, f.metadata.get('magic.mime-type'))
+		except:
+			db.discard_staged(staged)
+			raise
+
+		return source_file, staged, f
+
+	if jobs <= 1:
+		yield from map(_stage, source_files)
+		return
+
+	with futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+		pending = collections.deque()
+
+		try:
+			for source_file in source_files:
+				pending.append(executor.submit(_stage, source_file))
+
+				# We only keep a few files in flight per worker, so that we don't stage (and use
+				# disk space for) the whole set before the first file is added.
+				if len(pending) >= jobs * 2:
+					yield pending.popleft().result()
+
+			while pending:
+				yield pending.popleft().result()
+		finally:
+			# If we were stopped early, clean up after any files that were staged but never added.
+			for future in pending:
+				if not future.cancel() and future.exception() is None and not isinstance(future.result()[1], OSError):
+					db.discard_staged(future.result()[1])
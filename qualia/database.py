@@ -17,14 +17,23 @@
 
 ## Imports
 from .lazy_import import lazy_import
-from . import common, config, journal, search
+from . import bloom, common, config, duplicates, hashindex, journal, packs, search
 
 lazy_import(globals(), """
 	import codecs
+	from concurrent import futures
+	# (`conversion` imports this module, so it can only be imported lazily here.)
+	from qualia import conversion
 	import datetime
+	import errno
+	import fcntl
 	import glob
+	import gzip
 	import hashlib
+	import io
 	import itertools
+	import lzma
+	import mmap
 	import os
 	from os import path
 	import shutil
@@ -39,6 +48,73 @@ lazy_import(globals(), """
 
 VERSION = 1
 
+# Files are always read in chunks of this size while hashing or copying them, so that memory use
+# stays constant no matter how large the file is.
+CHUNK_SIZE = 1024 * 1024
+
+# The `ioctl` used to make a copy-on-write clone of a file on Linux (from `linux/fs.h`).
+FICLONE = 0x40049409
+
+# Stored files can be compressed with any of these, in which case their filename has the given
+# suffix. `'zlib'` uses the gzip container, so that it can be read as a stream.
+COMPRESSION_SUFFIXES = {
+	'zlib': '.gz',
+	'lzma': '.xz',
+}
+
+_COMPRESSORS = {
+	'zlib': lambda f: gzip.GzipFile(fileobj = f, mode = 'wb', mtime = 0),
+	'lzma': lambda f: lzma.LZMAFile(f, mode = 'wb'),
+}
+
+_DECOMPRESSORS = {
+	'zlib': lambda f: gzip.GzipFile(fileobj = f, mode = 'rb'),
+	'lzma': lambda f: lzma.LZMAFile(f, mode = 'rb'),
+}
+
+# Files with these MIME types (as found by the `magic` plugin) are already compressed, so there's
+# no point trying to compress them again.
+INCOMPRESSIBLE_MIME_TYPES = set([
+	'application/gzip',
+	'application/pdf',
+	'application/vnd.rar',
+	'application/x-7z-compressed',
+	'application/x-bzip2',
+	'application/x-gzip',
+	'application/x-rar',
+	'application/x-xz',
+	'application/zip',
+	'audio/flac',
+	'audio/mpeg',
+	'audio/ogg',
+	'image/gif',
+	'image/jpeg',
+	'image/png',
+	'image/webp',
+	'video/mp4',
+	'video/quicktime',
+	'video/webm',
+	'video/x-matroska',
+])
+
+# Stored files can be nested this many directories deep; see `Database.get_directory_for_hash`.
+MAX_LAYOUT_DEPTH = 4
+
+# These create a new hash object for each of the hash schemes listed in `config.HASH_SCHEMES`.
+HASH_CONSTRUCTORS = {
+	'blake2b-256': lambda: hashlib.blake2b(digest_size = 32),
+	'blake2b-512': lambda: hashlib.blake2b(),
+	'sha256': lambda: hashlib.sha256(),
+	'sha512': lambda: hashlib.sha512(),
+}
+
+# These are the ways `Database.stage_file` can get the contents of a file into the object store;
+# see `Database._stage_linked` for details.
+LINK_MODES = ['auto', 'reflink', 'hardlink', 'copy']
+
+# `Database.rebuild_duplicates` reports its progress after every this many files.
+DUPLICATES_PROGRESS_INTERVAL = 1000
+
 ## Utility functions
 # Get the default database location, respecting the default or any user-configured XDG data
 # directories.
@@ -54,6 +130,55 @@ def _validate_hash(hash):
 
 	return hash.lower()
 
+# This feeds the rest of the given file into `hashobj`, reusing a single buffer for each chunk.
+def _hash_file(hashobj, source_file):
+	buf = bytearray(CHUNK_SIZE)
+	view = memoryview(buf)
+
+	while True:
+		length = source_file.readinto(buf)
+		if not length: break
+
+		hashobj.update(view[:length])
+
+	return hashobj
+
+# This feeds the first `size` bytes of the file open as `source_fd` into `hashobj` through a
+# read-only memory map. If `dest_fd` is given, each chunk is also copied into it with
+# `os.copy_file_range` just before it's hashed, so the copy and the hash are done in one pass over
+# the (by then cached) source.
+def _hash_mapped(hashobj, source_fd, size, dest_fd = None):
+	if dest_fd is not None and not hasattr(os, 'copy_file_range'):
+		raise OSError(errno.ENOSYS, 'copy_file_range is not supported')
+
+	# Empty files can't be mapped, but have nothing to hash or copy anyway.
+	if size == 0: return hashobj
+
+	with mmap.mmap(source_fd, size, access = mmap.ACCESS_READ) as source_map, memoryview(source_map) as view:
+		offset = 0
+
+		while offset < size:
+			length = min(CHUNK_SIZE, size - offset)
+
+			if dest_fd is not None:
+				length = os.copy_file_range(source_fd, dest_fd, length, offset, offset)
+				if not length: raise OSError(errno.EIO, 'file was truncated while being copied')
+
+			hashobj.update(view[offset:offset + length])
+			offset += length
+
+	return hashobj
+
+# Splits up the given iterator into lists of at most `size` items.
+def _batches(iterable, size):
+	iterator = iter(iterable)
+
+	while True:
+		batch = list(itertools.islice(iterator, size))
+		if not batch: break
+
+		yield batch
+
 ## File
 # This class is the core container for all files within a database.
 #
@@ -93,6 +218,29 @@ class File:
 	def __repr__(self):
 		return 'qualia.database.File(..., {!r}, {{...}})'.format(self.hash)
 
+## Staged files
+# This holds the result of `Database.stage_file`: the hash of a file that is about to be added, and
+# the name of the file (either a temporary copy inside the object store, or the original file if it
+# can be renamed into place) that will become its stored contents.
+#
+# If `stage_file` found that the file is already stored, `staged_name` is `None`. The size and
+# partial hash are kept for the duplicate index, and `compression` is set if
+# `Database.compress_staged` compressed the staged copy. The MIME type given to `compress_staged` is
+# kept too, in case the file has to be staged again.
+class StagedFile:
+	def __init__(self, hash, source_name, staged_name, temporary, size, partial):
+		self.hash = hash
+		self.source_name = source_name
+		self.staged_name = staged_name
+		self.temporary = temporary
+		self.size = size
+		self.partial = partial
+		self.compression = None
+		self.mime_type = None
+
+	def __repr__(self):
+		return 'qualia.database.StagedFile({!r}, {!r}, ...)'.format(self.hash, self.source_name)
+
 ## Database
 # This is the core database class, and contains most code that operates directly on the set of
 # stored files as well as serving as an intermediary to the journal and search index.
@@ -114,20 +262,61 @@ class Database:
 		# Then we do some simple version checking.
 		if self.state['version'] is None:
 			self.state['version'] = VERSION
+			# New databases use the configured hash scheme; older ones keep whichever they started
+			# with (or SHA-512, if they're from before it could be changed).
+			self.state['hash-scheme'] = config.conf.get('hash-scheme') or self.state['hash-scheme']
+			self.state['layout']['depth'] = config.conf.get('layout-depth') or self.state['layout']['depth']
 		elif self.state['version'] != VERSION:
 			raise RuntimeError('Cannot open database of version {} (only support version {})'.format(self.state['version'], VERSION))
 
 		self.journal = journal.Journal(path.join(self.db_path, 'journal'), read_only = read_only)
 		self.searchdb = search.SearchDatabase(self, path.join(self.db_path, 'search'), read_only = read_only)
+		self.packs = packs.PackStore(path.join(self.db_path, 'packs'), read_only = read_only)
+
+		# The duplicate index is only needed when adding files.
+		if read_only:
+			self.duplicates = None
+		else:
+			self.duplicates = duplicates.DuplicateIndex(path.join(self.db_path, 'duplicates'))
+
+		# An interrupted `migrate_hash` has to be finished before the hash index can be used, as
+		# the search index may have some of the new hashes and some of the old.
+		if self.state['hash-migration'] is not None:
+			if read_only: raise common.MigrationInProgressError(self.state['hash-migration'])
+
+			self._finish_hash_migration()
+
+		# The hash index is rebuilt from the search index if it's missing or out of date.
+		self.hashindex = hashindex.HashIndex(path.join(self.db_path, 'hashes'), self.new_hash().digest_size, read_only = read_only)
+		if not self.hashindex.is_current(self.searchdb.generation()): self.rebuild_hash_index()
+
+		# A database without any files (like a new one) has no older files to add to the duplicate
+		# index, so it's complete as it is.
+		if self.duplicates and not len(self.hashindex) and not self.duplicates.built: self.duplicates.mark_built()
+
+		# As is the filter in front of it (see `exists`).
+		self.filter = bloom.BloomFilter(path.join(self.db_path, 'filter'), read_only = read_only)
+		if not self.filter.is_current(self.searchdb.generation()): self.rebuild_filter()
 
 	# This should be called once the UI is done with the database.
 	#
-	# Currently, this only saves the `state`, as the journal and search index are only kept open for
-	# long enough to make changes.
+	# This saves the `state` and closes the searcher that the search index keeps open between
+	# lookups; the journal is only kept open for long enough to make changes.
 	def close(self):
+		self.searchdb.close()
+
 		if not self.read_only:
-			config.save(os.path.join(self.db_path, 'state'), self.state, config.DB_STATE_BASE)
-	
+			self.save_state()
+
+	# Writes out the `state` file. This is normally only done by `close`, but some operations (like
+	# migrations) need the state to be on disk before they continue.
+	def save_state(self):
+		config.save(os.path.join(self.db_path, 'state'), self.state, config.DB_STATE_BASE)
+
+	# Creates a new hash object for this database's hash scheme.
+	def new_hash(self):
+		return HASH_CONSTRUCTORS[self.state['hash-scheme']]()
+
 	# Internal convenience function to raise an error if database is read-only.
 	def _require_read_write(self):
 		if self.read_only: raise common.DatabaseReadOnlyError()
@@ -141,37 +330,221 @@ class Database:
 			os.mkdir(path.join(self.db_path, 'files'))
 			os.mkdir(path.join(self.db_path, 'search'))
 
-	# These translate hashes to the full path on disk where the files are stored.
-	def get_directory_for_hash(self, hash):
-		return path.join(self.db_path, 'files', hash[0:2])
+	# These translate hashes to the full path on disk where the files are stored. Files are nested
+	# under `depth` levels of directories named after successive pairs of characters from their
+	# hash, so with a depth of 2, `abcdef...` is stored in `files/ab/cd/abcdef...`.
+	def get_directory_for_hash(self, hash, depth = None):
+		depth = self.state['layout']['depth'] if depth is None else depth
+
+		return path.join(self.db_path, 'files', *(hash[i:i + 2] for i in range(0, depth * 2, 2)))
+
+	# While `migrate_layout` is running (or if it was interrupted), files may still be in their
+	# previous location.
+	def get_filename_for_hash(self, hash, suffix = ''):
+		filename = path.join(self.get_directory_for_hash(hash), hash + suffix)
+		previous_depth = self.state['layout']['previous-depth']
+
+		if previous_depth is not None and not path.exists(filename):
+			previous_filename = path.join(self.get_directory_for_hash(hash, previous_depth), hash + suffix)
+			if path.exists(previous_filename): return previous_filename
+
+		return filename
+
+	# Finds the file the given (unpacked) hash is actually stored in, returning `(filename,
+	# compression)`. Compressed files have a suffix, so this may need to check a few names.
+	def _stored_filename(self, hash):
+		filename = self.get_filename_for_hash(hash)
+		if path.exists(filename): return filename, None
+
+		for compression, suffix in COMPRESSION_SUFFIXES.items():
+			compressed_filename = self.get_filename_for_hash(hash, suffix)
+			if path.exists(compressed_filename): return compressed_filename, compression
+
+		return filename, None
+
+	# Opens the stored contents of the given hash for reading, whether it's in a pack or a file of
+	# its own, decompressing it on the fly if needed.
+	def _open_object(self, hash):
+		location = self.packs.get(hash)
+
+		if location:
+			f = io.BytesIO(self.packs.read(hash))
+			compression = location[3]
+		else:
+			filename, compression = self._stored_filename(hash)
+			f = open(filename, 'rb')
+
+		return _DECOMPRESSORS[compression](f) if compression else f
+
+	# Returns the (uncompressed) size of the given hash. This has to read compressed files in full.
+	def _object_size(self, hash):
+		location = self.packs.get(hash)
+
+		if location and not location[3]:
+			return location[2]
+		elif not location:
+			filename, compression = self._stored_filename(hash)
+			if not compression: return path.getsize(filename)
+
+		size = 0
+
+		with self._open_object(hash) as f:
+			for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+				size += len(chunk)
+
+		return size
+
+	# Removes the stored contents for the given hash, along with any directories that leaves empty
+	# or any copy of it in `cache/` (see `get_filename`).
+	def _unlink_object(self, hash):
+		try:
+			os.unlink(path.join(self.db_path, 'cache', hash))
+		except FileNotFoundError:
+			pass
+
+		if hash in self.packs:
+			self.packs.delete(hash)
+			return
+
+		filename, _ = self._stored_filename(hash)
+		os.unlink(filename)
+		self._remove_empty_directories(path.dirname(filename))
+
+	def _remove_empty_directories(self, directory):
+		files_path = path.join(self.db_path, 'files')
+
+		while directory != files_path:
+			try:
+				os.rmdir(directory)
+			except OSError:
+				break
+
+			directory = path.dirname(directory)
+
+	# Yields the full filenames of all the stored files that are nested exactly `depth` directories
+	# deep. Each directory is read in full before anything in it is yielded, so it's safe to move
+	# the files as they're found.
+	def _stored_files_at_depth(self, depth, directory = None, level = 0):
+		directory = directory or path.join(self.db_path, 'files')
+
+		with os.scandir(directory) as it:
+			entries = list(it)
+
+		for entry in entries:
+			if level < depth:
+				if entry.is_dir(follow_symlinks = False):
+					yield from self._stored_files_at_depth(depth, entry.path, level + 1)
+			elif entry.is_file(follow_symlinks = False):
+				yield entry.path
+
+	# Moves every stored file into a layout with the given depth, `batch_size` files at a time,
+	# yielding the total number of files moved after each batch.
+	#
+	# The new layout is recorded (along with the previous one) before anything is moved, so the
+	# database can be used normally while this runs, and running this again with the same depth
+	# will pick up where an interrupted run left off.
+	def migrate_layout(self, depth, batch_size = 1000):
+		self._require_read_write()
+
+		layout = self.state['layout']
 
-	def get_filename_for_hash(self, hash):
-		return path.join(self.get_directory_for_hash(hash), hash)
+		if not 1 <= depth <= MAX_LAYOUT_DEPTH:
+			raise ValueError(depth)
+
+		if layout['previous-depth'] is None:
+			if depth == layout['depth']: return
+
+			layout['previous-depth'], layout['depth'] = layout['depth'], depth
+			self.save_state()
+		elif depth != layout['depth']:
+			raise common.MigrationInProgressError(layout['depth'])
+
+		moved = 0
+
+		for batch in _batches(self._stored_files_at_depth(layout['previous-depth']), batch_size):
+			for old_filename in batch:
+				hash = path.basename(old_filename)
+				new_directory = self.get_directory_for_hash(hash)
+
+				os.makedirs(new_directory, exist_ok = True)
+				os.rename(old_filename, path.join(new_directory, hash))
+
+			moved += len(batch)
+			yield moved
+
+		# Any directories that are no longer needed (including those emptied by an earlier,
+		# interrupted run) are cleaned up once everything is in place.
+		for directory, subdirectories, filenames in os.walk(path.join(self.db_path, 'files'), topdown = False):
+			if not subdirectories and not filenames:
+				self._remove_empty_directories(directory)
+
+		layout['previous-depth'] = None
+		self.save_state()
 	
-	### Manipulation
-	def add_file(self, source_file, move = False, source = 'user'):
+	# Converts journal entries written before the current encoding, `batch_size` at a time, yielding
+	# the total converted after each batch; see `qualia.journal.Journal.migrate_extra`. This is also
+	# done a batch at a time at each commit, so it only needs to be run to finish the job at once.
+	def migrate_journal(self, batch_size = 10000):
 		self._require_read_write()
 
-		def _prepare_filename(hash):
-			if self.exists(hash):
-				raise common.FileExistsError(hash)
+		# Each batch is committed separately, so anything pending has to be committed first.
+		self.commit()
 
-			# While `makedirs` isn't strictly necessary in the current arrangement, it is useful
-			# future-proofing for a more deeply nested storage structure.
-			os.makedirs(self.get_directory_for_hash(hash), exist_ok = True)
-			filename = self.get_filename_for_hash(hash)
+		yield from self.journal.migrate_extra(batch_size)
 
-			return filename
+	### Manipulation
+	# Adding a file is split into two phases. `stage_file` does all of the expensive work (hashing
+	# the file and copying it into the object store under a temporary name) without touching the
+	# journal or search index, so it can be run for several files at once (see
+	# `qualia.conversion.stage_files`). `add_staged` then checks for duplicates and registers the
+	# file, and should only ever be called from one thread at a time.
+	def stage_file(self, source_file, move = False, link = 'auto', check_duplicates = True):
+		self._require_read_write()
 
-		copy = not move
+		files_path = path.join(self.db_path, 'files')
 
-		if move:
+		# The duplicate check and any kernel-side copies need a real file descriptor, which (for
+		# instance) files inside an import ZIP don't have.
+		try:
+			source_fd = source_file.fileno()
+			source_stat = os.fstat(source_fd)
+		except (AttributeError, io.UnsupportedOperation):
+			source_fd = source_stat = None
+
+		# They also need to read the file at an offset, and to know its size up front, which only
+		# works for regular files; anything else (like a pipe) can only be read through once.
+		regular = source_stat is not None and stat.S_ISREG(source_stat.st_mode)
+
+		if regular:
+			size = source_stat.st_size
+			partial = duplicates.partial_hash(os.pread(source_fd, duplicates.PARTIAL_SIZE, 0))
+
+		# If we're moving a file that's on the same filesystem as the object store, all we need is
+		# the hash; `add_staged` can then simply rename it into place.
+		if move and regular:
 			try:
-				hash = hashlib.sha512(source_file.read()).hexdigest()
-				filename = _prepare_filename(hash)
-				os.rename(source_file.name, filename)
+				if os.stat(source_file.name).st_dev == os.stat(files_path).st_dev:
+					hash = _hash_file(self.new_hash(), source_file).hexdigest()
+
+					return StagedFile(hash, source_file.name, source_file.name, False, size, partial)
 			except OSError:
-				copy = True
+				pass
+
+		# Before writing anything, we check whether any stored files have the same size and
+		# beginning. Only then does the file need to be hashed in full (without copying it) to see
+		# whether it's really a duplicate; if so, `add_staged` will reject it.
+		if regular and check_duplicates:
+			candidates = self.duplicates.find(size, partial)
+
+			if candidates:
+				hash = _hash_mapped(self.new_hash(), source_fd, size).hexdigest()
+
+				if hash in candidates:
+					return StagedFile(hash, source_file.name, None, False, size, partial)
+
+		if link != 'copy':
+			staged = self._stage_linked(source_file, source_fd, link)
+			if staged: return staged
 
 		# While technically, we could just grab the hash, seek to the beginning of the file, then
 		# copy the file, we do it this more complicated way for two reasons:
@@ -179,32 +552,186 @@ class Database:
 		#   1. It's more efficient (though not by much on an SSD).
 		#   2. Adding files from a compressed import tarball is abysmallly slow if you seek.
 		#
-		if copy:
-			hashobj = hashlib.sha512()
+		hashobj = self.new_hash()
+		head = b''
+		size = 0
+		tmp_file = tempfile.NamedTemporaryFile(dir = files_path, delete = False)
 
-			try:
-				tmp_file = tempfile.NamedTemporaryFile(dir = path.join(self.db_path, 'files'), delete = False)
-				chunk = source_file.read(16384)
+		try:
+			with tmp_file:
+				chunk = source_file.read(CHUNK_SIZE)
 				while chunk:
 					hashobj.update(chunk)
 					tmp_file.write(chunk)
-					chunk = source_file.read(16384)
 
-				tmp_file.flush()
-				hash = hashobj.hexdigest()
-				filename = _prepare_filename(hash)
-				os.rename(tmp_file.name, filename)
-			except:
-				# We have to do this manually, as we don't want the file to be deleted if we succeed
-				# and it gets renamed.
-				os.unlink(tmp_file.name)
-				raise
+					if len(head) < duplicates.PARTIAL_SIZE: head += chunk[:duplicates.PARTIAL_SIZE - len(head)]
+					size += len(chunk)
+
+					chunk = source_file.read(CHUNK_SIZE)
+		except:
+			# We have to do this manually, as we don't want the file to be deleted if we succeed
+			# and it gets renamed.
+			os.unlink(tmp_file.name)
+			raise
+
+		return StagedFile(hashobj.hexdigest(), source_file.name, tmp_file.name, True, size, duplicates.partial_hash(head))
+
+	# This tries to stage the given file without pushing its contents through Python, depending on
+	# `link`:
+	#
+	#   * `'hardlink'` links the source straight into the object store. This is only safe if the
+	#     source will never be modified again, and note that it will be made read-only along with
+	#     the stored file.
+	#   * `'reflink'` makes a copy-on-write clone of the source, on filesystems (like btrfs and XFS)
+	#     that support it.
+	#   * `'auto'` tries a reflink, then falls back to `os.copy_file_range`, which at least keeps
+	#     the copy inside the kernel (and may turn into a reflink or server-side copy anyway).
+	#
+	# The hash is always computed through a memory map of the source. If `link` is `'auto'` and
+	# none of this is possible, this returns `None` so the caller can copy the file itself;
+	# otherwise, any errors are raised.
+	#
+	# All of this relies on the size of the source, so anything but a regular file (like a pipe) is
+	# always left to the caller, whatever `link` is. So are empty files, as files in `/proc` claim to
+	# be empty whatever they contain (and a real empty file is no trouble to copy).
+	def _stage_linked(self, source_file, source_fd, link):
+		if source_fd is None:
+			if link == 'auto': return None
+			raise OSError(errno.EBADF, 'cannot {} a file without a descriptor'.format(link), source_file.name)
+
+		source_stat = os.fstat(source_fd)
+		if not stat.S_ISREG(source_stat.st_mode) or source_stat.st_size == 0: return None
+
+		size = source_stat.st_size
+		fd, tmp_name = tempfile.mkstemp(dir = path.join(self.db_path, 'files'))
+
+		try:
+			if link == 'hardlink':
+				# Nobody else should be creating files in `files/`, so it's safe to briefly free up
+				# the temporary name for the link.
+				os.unlink(tmp_name)
+				os.link(source_file.name, tmp_name)
+				hashobj = _hash_mapped(self.new_hash(), source_fd, size)
+			else:
+				try:
+					fcntl.ioctl(fd, FICLONE, source_fd)
+					hashobj = _hash_mapped(self.new_hash(), source_fd, size)
+				except OSError:
+					if link == 'reflink': raise
+					hashobj = _hash_mapped(self.new_hash(), source_fd, size, dest_fd = fd)
+		except OSError:
+			try:
+				os.unlink(tmp_name)
+			except FileNotFoundError:
+				pass
+
+			if link == 'auto': return None
+			raise
+		finally:
+			os.close(fd)
+
+		partial = duplicates.partial_hash(os.pread(source_fd, duplicates.PARTIAL_SIZE, 0))
+
+		return StagedFile(hashobj.hexdigest(), source_file.name, tmp_name, True, size, partial)
+
+	# If this database is configured to compress stored files, this compresses the given staged
+	# file, keeping the compressed copy only if it's actually smaller. Files whose MIME type (if
+	# known) shows they're already compressed are skipped. Like `stage_file`, this can be run for
+	# several files at once.
+	def compress_staged(self, staged, mime_type = None):
+		compression = config.conf.get('compression', 'none')
+		staged.mime_type = mime_type
+
+		if compression == 'none' or staged.staged_name is None or mime_type in INCOMPRESSIBLE_MIME_TYPES:
+			return
+
+		tmp_file = tempfile.NamedTemporaryFile(dir = path.join(self.db_path, 'files'), delete = False)
+
+		try:
+			with tmp_file, open(staged.staged_name, 'rb') as source, _COMPRESSORS[compression](tmp_file) as dest:
+				shutil.copyfileobj(source, dest, CHUNK_SIZE)
+		except:
+			os.unlink(tmp_file.name)
+			raise
+
+		if path.getsize(tmp_file.name) >= staged.size:
+			os.unlink(tmp_file.name)
+			return
+
+		# For a file being moved, the original will then be removed by `add_staged`.
+		self.discard_staged(staged)
+		staged.staged_name = tmp_file.name
+		staged.temporary = True
+		staged.compression = compression
+
+	# Throws away a staged file that will not be added after all.
+	def discard_staged(self, staged):
+		if staged.temporary:
+			os.unlink(staged.staged_name)
+
+	def add_staged(self, staged, move = False, source = 'user', link = 'auto'):
+		self._require_read_write()
+
+		hash = staged.hash
+		filename = self.get_filename_for_hash(hash)
+
+		if staged.staged_name is None:
+			if self.exists(hash):
+				raise common.FileExistsError(hash)
+
+			# The duplicate index was out of date, so the file has to be staged properly after all.
+			mime_type = staged.mime_type
+
+			with open(staged.source_name, 'rb') as source_file:
+				staged = self.stage_file(source_file, move, link, check_duplicates = False)
+
+			self.compress_staged(staged, mime_type)
+
+		try:
+			if self.exists(hash):
+				raise common.FileExistsError(hash)
+
+			# Small files are appended to a pack rather than being stored on their own.
+			packed = staged.size < config.conf.get('pack-threshold', 0)
+
+			if packed:
+				with open(staged.staged_name, 'rb') as staged_file:
+					self.packs.append(hash, staged_file.read(), staged.compression)
+			else:
+				filename += COMPRESSION_SUFFIXES.get(staged.compression, '')
+
+				os.makedirs(self.get_directory_for_hash(hash), exist_ok = True)
+				os.rename(staged.staged_name, filename)
+		except OSError:
+			self.discard_staged(staged)
+			if staged.temporary: raise
+
+			# The rename of a moved file can still fail (for instance, if it can't be removed from
+			# its current directory), in which case we fall back to copying it.
+			mime_type = staged.mime_type
+
+			with open(staged.source_name, 'rb') as source_file:
+				staged = self.stage_file(source_file, False, link)
+
+			self.compress_staged(staged, mime_type)
 
-			if move:
-				os.unlink(source_file.name)
+			return self.add_staged(staged, move, source, link)
+		except:
+			self.discard_staged(staged)
+			raise
+
+		# Once packed, the staged copy (or, for a move, the original) isn't needed any more.
+		if packed:
+			os.unlink(staged.staged_name)
+
+		if move and staged.temporary:
+			os.unlink(staged.source_name)
 
 		self.journal.append(source, hash, 'add')
 		self.searchdb.add(hash)
+		self.hashindex.add(hash)
+		self.filter.add(hash)
+		self.duplicates.add(hash, staged.size, staged.partial)
 
 		# This is apparently the required song and dance to get the current umask.
 		old_umask = os.umask(0)
@@ -213,13 +740,63 @@ class Database:
 		# We then use the umask to mask out any undesired bits from our default permissions, which
 		# are `r--r--r--`. The files are marked read-only in order to emphasize their immutability
 		# and strong tie to their hash.
-		os.chmod(filename, (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH) & ~old_umask)
+		if not packed:
+			os.chmod(filename, (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH) & ~old_umask)
 
 		return File(self, hash, {})
 
+	# The MIME type is only used to decide whether to compress the file; if it isn't given, it is
+	# detected with `conversion.detect_mime_type` (the same way the `magic` importer run by
+	# `conversion.stage_files` does).
+	def add_file(self, source_file, move = False, source = 'user', link = 'auto', mime_type = None):
+		staged = self.stage_file(source_file, move, link)
+
+		if mime_type is None and staged.staged_name is not None and config.conf.get('compression', 'none') != 'none':
+			try:
+				mime_type = conversion.detect_mime_type(staged.staged_name)
+			except:
+				self.discard_staged(staged)
+				raise
+
+		self.compress_staged(staged, mime_type)
+
+		return self.add_staged(staged, move, source, link)
+
 	def add(self, source_filename, *args, **kwargs):
 		return self.add_file(open(source_filename, 'rb'), *args, **kwargs)
 
+	# Fills in the duplicate index with every stored file, yielding `(indexed, total)` files every
+	# `DUPLICATES_PROGRESS_INTERVAL` files. This only needs to be done once, for databases that
+	# already held files before the index existed; until then, duplicates of their files are still
+	# rejected, but only after being copied.
+	def rebuild_duplicates(self):
+		self._require_read_write()
+
+		total = len(self.hashindex)
+		indexed = 0
+
+		for metadata in self.searchdb.all():
+			with self._open_object(metadata['hash']) as f:
+				head = f.read(duplicates.PARTIAL_SIZE)
+
+			self.duplicates.add(metadata['hash'], self._object_size(metadata['hash']), duplicates.partial_hash(head))
+			indexed += 1
+
+			if indexed % DUPLICATES_PROGRESS_INTERVAL == 0:
+				self.duplicates.commit()
+				yield indexed, total
+
+		self.duplicates.mark_built()
+		if indexed % DUPLICATES_PROGRESS_INTERVAL: yield indexed, total
+
+	# Refills the hash index from the search index.
+	def rebuild_hash_index(self):
+		self.hashindex.rebuild((metadata['hash'] for metadata in self.searchdb.all()), self.searchdb.generation())
+
+	# Refills the Bloom filter from the hash index.
+	def rebuild_filter(self):
+		self.filter.rebuild(self.hashindex.find(''), len(self.hashindex), self.searchdb.generation())
+
 	# This restores the most recent version of metadata from the journal for the given hash. 
 	#
 	# By default, it does not do so for automatically-added metadata, assuming that it will be
@@ -234,18 +811,18 @@ class Database:
 		for transaction in self.journal.get_transactions(f.hash, 'set'):
 			if no_auto and transaction['source'] == 'auto': continue
 
-			field, value = transaction['extra']
+			field, old_value, value = transaction['extra']
 
-			modifications[field] = transaction['source'], field, value
+			modifications[field] = transaction['source'], value
 
-		for source, field, value in modifications.items():
+		for field, (source, value) in modifications.items():
 			f.set_metadata(field, value, source = source)
 
 	# This gives all of the hashes that start with a given prefix.
 	def find_hashes(self, prefix):
 		prefix = _validate_hash(prefix)
 
-		return self.searchdb.find_hashes(prefix)
+		return self.hashindex.find(prefix)
 	
 	# This gets the shortest unambiguous shortened version of the given hash.
 	def get_shortest_hash(self, hash):
@@ -253,20 +830,67 @@ class Database:
 		# for some time but are not too short.
 		baselen = 4
 
-		while True:
-			# This is a bit ugly, but basically gets the first two results from the iterator
-			# returned by `find_hashes`. If it gets a second result, the prefix is ambiguous.
-			result = self.find_hashes(hash[:baselen])
-			_, extra = next(result, None), next(result, None)
-
-			if extra is None: break
-			baselen += 2
+		# The prefix is ambiguous until it's longer than the part the hash shares with its
+		# neighbours in the hash index.
+		unique_length = self.hashindex.unique_prefix_length(hash)
+		while baselen < unique_length: baselen += 2
 
 		return hash[:baselen]
 
-	# Just a quick convenience method.
+	# Opens the contents of the given file for reading. This should be used instead of
+	# `get_filename` wherever possible, as it doesn't need to copy files out of packs.
+	def open(self, f):
+		return self._open_object(f.hash)
+
+	# Returns the name of a file on disk with the contents of the given file. Files that are
+	# packed or compressed are copied out into `cache/` the first time this is needed, which is
+	# kept to the `cache-size` option by `_trim_cache`.
 	def get_filename(self, f):
-		return self.get_filename_for_hash(f.hash)
+		if f.hash not in self.packs:
+			filename, compression = self._stored_filename(f.hash)
+			if not compression: return filename
+
+		filename = path.join(self.db_path, 'cache', f.hash)
+
+		if path.exists(filename):
+			# The modification time marks when each copy was last used (as access times often
+			# aren't kept up to date).
+			os.utime(filename)
+		else:
+			os.makedirs(path.dirname(filename), exist_ok = True)
+
+			with tempfile.NamedTemporaryFile(dir = path.dirname(filename), delete = False) as tmp_file, self.open(f) as source:
+				shutil.copyfileobj(source, tmp_file, CHUNK_SIZE)
+
+			os.chmod(tmp_file.name, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+			os.rename(tmp_file.name, filename)
+
+			self._trim_cache(keep = f.hash)
+
+		return filename
+
+	# Removes the least recently used copies in `cache/` until they fit in the `cache-size` option,
+	# apart from the one for `keep` and any that are still being written (by another process).
+	def _trim_cache(self, keep = None):
+		try:
+			with os.scandir(path.join(self.db_path, 'cache')) as it:
+				entries = [(entry.name, entry.path, entry.stat()) for entry in it if not entry.name.startswith('tmp')]
+		except FileNotFoundError:
+			return
+
+		size = sum(stat_result.st_size for _, _, stat_result in entries)
+		limit = config.conf.get('cache-size', 1024) * 1024 * 1024
+
+		for name, filename, stat_result in sorted(entries, key = lambda entry: entry[2].st_mtime):
+			if size <= limit: break
+			if name == keep: continue
+
+			try:
+				os.unlink(filename)
+			except FileNotFoundError:
+				pass
+
+			size -= stat_result.st_size
 
 	# Returns a generator giving all the file objects that exist in the database.
 	def all(self):
@@ -275,33 +899,79 @@ class Database:
 
 	# Gets the `File` object for a given short hash.
 	def get(self, short_hash):
-		result = self.find_hashes(short_hash)
-		hash, extra = next(result, None), next(result, None)
+		return self.get_many([short_hash])[0]
+
+	# Gets the `File` objects for a list of short hashes, in the same order. All the hashes are
+	# resolved with the hash index before their metadata is fetched in one go.
+	#
+	# Like `get`, this raises an error for the first short hash that doesn't match exactly one file,
+	# unless `return_errors` is set; in that case, the error is put in the list in place of the
+	# `File`.
+	def get_many(self, short_hashes, *, return_errors = False):
+		hashes = []
 
-		if hash is None:
-			raise common.FileDoesNotExistError(short_hash)
+		for short_hash in short_hashes:
+			result = self.find_hashes(short_hash)
+			hash, extra = next(result, None), next(result, None)
 
-		if extra is not None:
-			raise common.AmbiguousHashError(short_hash)
+			if hash is None:
+				hash = common.FileDoesNotExistError(short_hash)
+			elif extra is not None:
+				hash = common.AmbiguousHashError(short_hash)
 
-		return File(self, hash, self.searchdb.get(hash))
+			if isinstance(hash, Exception) and not return_errors: raise hash
+			hashes.append(hash)
 
-	# Deletes both the underlying file and metadata for a given file.
-	#
-	# TODO: Make this atomic; currently, if a user deletes a set of files and it fails halfway
-	# through, the search database and journal will be consistent but some of the actual files will
-	# be deleted. This will likely require postponing the actual unlink until some kind of GC phase.
+		metadata = self.searchdb.get_many([hash for hash in hashes if isinstance(hash, str)])
+
+		return [hash if isinstance(hash, Exception) else File(self, hash, metadata[hash]) for hash in hashes]
+
+	# Deletes the metadata for a given file. The journal entry serves as a tombstone for the stored
+	# contents, which are only removed by `collect_garbage`; this keeps deletes as cheap as any other
+	# metadata change, and means nothing is lost if a set of deletes fails halfway through.
 	def delete(self, f, source = 'user'):
 		self._require_read_write()
 
 		self.journal.append(source, f.hash, 'delete')
-		os.unlink(self.get_filename_for_hash(f.hash))
 		self.searchdb.delete(f)
+		self.hashindex.delete(f.hash)
+		self.filter.delete(f.hash)
+		self.duplicates.delete(f.hash)
 
-		try:
-			os.rmdir(self.get_directory_for_hash(f.hash))
-		except OSError:
-			pass
+	# Removes the stored contents of all files deleted since the last run, in batches of
+	# `batch_size` (sorted by hash, so each batch touches as few directories as possible) with `jobs`
+	# threads. Yields the total number of files removed after each batch.
+	#
+	# Only deletes that are part of a checkpoint are considered, and files that have been added
+	# again since are left alone. The copies in `cache/` are also trimmed to the `cache-size`
+	# option.
+	def collect_garbage(self, jobs = 1, batch_size = 1000):
+		self._require_read_write()
+
+		hashes, last_serial = self.journal.get_deleted_files(self.state['gc-serial'])
+		hashes = [hash for hash in hashes if not self.exists(hash)]
+
+		def _remove(hash):
+			try:
+				self._unlink_object(hash)
+			except FileNotFoundError:
+				# This may have been removed by an earlier, interrupted run.
+				pass
+
+		removed = 0
+
+		with futures.ThreadPoolExecutor(max_workers = max(jobs, 1)) as executor:
+			for batch in _batches(hashes, batch_size):
+				for _ in executor.map(_remove, batch): pass
+
+				removed += len(batch)
+				yield removed
+
+		self.packs.commit()
+		self._trim_cache()
+
+		self.state['gc-serial'] = last_serial
+		self.save_state()
 
 	# Saves all the metadata for a given file.
 	def save(self, f):
@@ -317,16 +987,235 @@ class Database:
 
 	# Runs a search against the database and returns a generator with results.
 	#
-	# This iterator should always be read to completion; otherwise the search database is held open.
-	def search(self, query, limit = 10):
-		for result in self.searchdb.search(query, limit = limit):
-			yield File(self, result['hash'], result)
+	# Results are returned `limit` at a time; `page` gives which set of results to return, starting
+	# at 1. Each `File` returned also has a `cursor`, an opaque value that can be given as `after` to
+	# continue the search just after that file (and `page` then counts from there). A cursor only
+	# works until the database is next changed, after which it raises
+	# `common.InvalidCursorError` (see `qualia.search.SearchDatabase.search`).
+	#
+	# If `limit` is `None` or 0, all results are streamed in the order they're stored, rather than
+	# by relevance, and can't be split into pages or continued from a cursor.
+	#
+	# Results can instead be sorted by the field given in `sort`, in descending order if `reverse`
+	# is set.
+	#
+	# If only some fields are needed, they can be given in `fields`; the results are then just
+	# `dict`s of those fields, as they can't be used as `File`s without the rest of their metadata.
+	# With `cursors` set, these are returned as `(cursor, result)` pairs.
+	def search(self, query, limit = 10, *, page = 1, after = None, sort = None, reverse = False, fields = None, cursors = False):
+		limit = limit or None
+		if page < 1: raise ValueError(page)
+		if limit is None and (page != 1 or after is not None): raise ValueError('pages and cursors need a limit')
+
+		results = self.searchdb.search(query, limit = limit, offset = (page - 1) * (limit or 0), sort = sort, reverse = reverse, fields = fields, after = after, cursors = True)
+
+		for cursor, result in results:
+			if fields is not None:
+				yield (cursor, result) if cursors else result
+				continue
+
+			f = File(self, result['hash'], result)
+			f.cursor = cursor
+
+			yield f
+
+	# Returns the number of files matching the given query.
+	def count(self, query):
+		return self.searchdb.count(query)
+
+	# Returns a `dict` giving how many files matching the query have each value of the given field.
+	def facet(self, query, field):
+		return self.searchdb.facet(query, field)
 
 	# Set a checkpoint, grouping together a set of individual transactions as a single operation.
+	#
+	# Changes to the search index can't be rolled back once the journal is committed (which records
+	# the generation of the index it goes with), and the hash index and filter are brought up to date
+	# with whatever the search index then looks like.
 	def commit(self):
 		self.searchdb.commit()
+		if not self.read_only:
+			self.packs.commit()
+			self.duplicates.commit()
+
+		checkpoint_id = self.journal.commit(search_generation = None if self.read_only else self.searchdb.generation())
+
+		if not self.read_only:
+			self.searchdb.finish_checkpoint()
+			self.hashindex.commit(self.searchdb.generation())
+
+			if self.filter.needs_rebuild:
+				self.rebuild_filter()
+			else:
+				self.filter.commit(self.searchdb.generation())
+
+		return checkpoint_id
+
+	# Rehashes every stored file with a new hash scheme, using `jobs` threads, and rewrites all the
+	# references to the old hashes in the object store, search index and journal. Returns the number
+	# of files rehashed.
+	#
+	# Nothing is changed until every file has been rehashed, apart from giving the loose objects
+	# their new names as hard links. The new scheme and the old and new hash of every file are then
+	# saved before anything is rewritten (see `_finish_hash_migration`), so if this is interrupted,
+	# opening the database again (for instance, to run this again) picks up where it left off.
+	def migrate_hash(self, scheme, jobs = 1):
+		self._require_read_write()
+
+		if scheme == self.state['hash-scheme']: return 0
+
+		new_hash = HASH_CONSTRUCTORS[scheme]
+
+		def _rehash(metadata):
+			with self._open_object(metadata['hash']) as f:
+				return metadata['hash'], _hash_file(new_hash(), f).hexdigest()
+
+		# Any pending changes have to be part of a finished checkpoint before the search index is
+		# rewritten.
+		self.commit()
+
+		renames = {}
+
+		with futures.ThreadPoolExecutor(max_workers = max(jobs, 1)) as executor:
+			for old_hash, hash in executor.map(_rehash, list(self.searchdb.all())):
+				renames[old_hash] = hash
+
+				# Packed files are simply renamed in the pack index.
+				if old_hash not in self.packs:
+					old_filename, compression = self._stored_filename(old_hash)
+
+					os.makedirs(self.get_directory_for_hash(hash), exist_ok = True)
+
+					try:
+						os.link(old_filename, self.get_filename_for_hash(hash, COMPRESSION_SUFFIXES.get(compression, '')))
+					except FileExistsError:
+						# This was linked by an earlier run that was interrupted while rehashing.
+						pass
+
+		renames_filename = path.join(self.db_path, 'hash-renames')
+
+		with open(renames_filename + '.new', 'w', encoding = 'utf-8') as f:
+			for old_hash, hash in renames.items():
+				f.write('{} {}\n'.format(old_hash, hash))
+
+			f.flush()
+			os.fsync(f.fileno())
+
+		os.replace(renames_filename + '.new', renames_filename)
+
+		self.state['hash-migration'] = scheme
+		self.save_state()
+
+		self._finish_hash_migration()
+
+		# The hash index has to be created again, as it has a different width.
+		self.hashindex = hashindex.HashIndex(self.hashindex.filename, self.new_hash().digest_size)
+		self.rebuild_hash_index()
+		self.rebuild_filter()
+
+		return len(renames)
+
+	# Switches everything over to the hashes saved by `migrate_hash`. Each step only changes what
+	# still has an old hash, so this can be run again if it's interrupted. The hash index and filter
+	# are left to the caller.
+	def _finish_hash_migration(self):
+		renames_filename = path.join(self.db_path, 'hash-renames')
+
+		with open(renames_filename, encoding = 'utf-8') as f:
+			renames = dict(line.split() for line in f)
+
+		for metadata in list(self.searchdb.all()):
+			old_hash = metadata['hash']
+			if old_hash not in renames: continue
+
+			hash = renames[old_hash]
+			self.searchdb.delete(File(self, old_hash, {}))
+			self.searchdb.save(File(self, hash, dict(metadata, hash = hash)))
+
+		self.searchdb.commit()
+		self.searchdb.finish_checkpoint()
+		self.journal.rename_files(renames)
+		self.duplicates.rename_files(renames)
+		self.packs.rename_files(renames)
 
-		return self.journal.commit()
+		# The search index and journal now only know about the new hashes.
+		self.state['hash-scheme'] = self.state['hash-migration']
+		self.state['hash-migration'] = None
+		self.save_state()
+
+		for old_hash in renames:
+			old_filename, _ = self._stored_filename(old_hash)
+			if path.exists(old_filename): self._unlink_object(old_hash)
+
+		os.unlink(renames_filename)
+
+	# Merges the search index into a single segment, yielding `(merged, total)` segments as it goes;
+	# see `qualia.search.SearchDatabase.optimize`.
+	def optimize_index(self):
+		self._require_read_write()
+
+		# Any pending changes have to be part of a finished checkpoint before segments can be merged.
+		self.commit()
+
+		yield from self.searchdb.optimize()
+
+		# The hash index and filter have to be told about the new generation of the search index.
+		self.commit()
+
+	# Replays the journal, yielding the latest metadata of every file that hasn't been deleted.
+	def _replay_journal(self):
+		for hash, transactions in self.journal.all_transactions_by_file():
+			metadata = None
+
+			for transaction in transactions:
+				if transaction['op'] == 'add':
+					metadata = {'hash': hash}
+				elif transaction['op'] == 'delete':
+					metadata = None
+				elif transaction['op'] == 'set' and metadata is not None:
+					field, old_value, value = transaction['extra']
+
+					if value is None:
+						metadata.pop(field, None)
+					else:
+						metadata[field] = value
+
+			if metadata is not None: yield metadata
+
+	# Rebuilds the search index from the journal with `jobs` processes, yielding `(indexed, total)`
+	# files as it goes; see `qualia.search.SearchDatabase.rebuild`. This is how changes to the type
+	# of a field are applied, so it also works on a read-only database (in which case the hash index
+	# and filter are only rebuilt on disk the next time the database is opened).
+	def reindex(self, jobs = 1):
+		if not self.read_only: self.commit()
+
+		# The journal is read through once first to find which fields are used.
+		field_names = set()
+		total = 0
+
+		for metadata in self._replay_journal():
+			field_names.update(metadata)
+			total += 1
+
+		yield from self.searchdb.rebuild(self._replay_journal(), field_names, total, jobs = jobs)
+
+		self.rebuild_hash_index()
+		self.rebuild_filter()
+
+	# Returns a report on the state of the search index; see `qualia.search.SearchDatabase.health`.
+	def index_health(self):
+		return self.searchdb.health()
+
+	# Returns how SQLite looks up transactions in the journal; see
+	# `qualia.journal.Journal.query_plans`.
+	def journal_query_plans(self):
+		return self.journal.query_plans()
+
+	# Rewrites all packs; see `qualia.packs.PackStore.repack`.
+	def repack(self):
+		self._require_read_write()
+
+		return self.packs.repack()
 
 	# Undo a given checkpoint (can be `None` to undo the latest).
 	def undo(self, checkpoint_id):
@@ -338,14 +1227,18 @@ class Database:
 		# Retrieve the checkpoint and make sure that we can undo all of its transactions.
 		checkpoint = self.journal.get_checkpoint(checkpoint_id)
 		if checkpoint is None: raise common.CheckpointDoesNotExistError(checkpoint_id)
+		if checkpoint['serial'] <= self.journal.compacted_serial(): raise common.CheckpointCompactedError(checkpoint['checkpoint_id'])
 
 		for transaction in checkpoint['transactions']:
 			if transaction['op'] not in CAN_UNDO: raise common.UndoFailedError(transaction)
 
 		# Undo each all transactions for each file in order. We also sort on operation, which
 		# coincidentally means that we can undo `add`s before trying to undo any relevant `set`s.
-		for hash, transactions in itertools.groupby(sorted(checkpoint['transactions'], key = lambda t: (t['file'], t['op'])), key = lambda t: t['file']):
-			f = self.get(hash)
+		transactions = sorted(checkpoint['transactions'], key = lambda t: (t['file'], t['op']))
+		files = {f.hash: f for f in self.get_many(set(t['file'] for t in transactions))}
+
+		for hash, transactions in itertools.groupby(transactions, key = lambda t: t['file']):
+			f = files[hash]
 
 			for transaction in transactions:
 				if transaction['op'] == 'add':
@@ -358,12 +1251,51 @@ class Database:
 			else:
 				self.save(f)
 
-	# Retrieve all checkpoints (with transactions). `order` can be set to `'asc'` or `'desc'`.
-	def all_checkpoints(self, *, order = 'asc'):
-		for checkpoint_id in self.journal.all_checkpoint_ids(order = order):
-			yield self.journal.get_checkpoint(checkpoint_id)
+	# Compacts the journal up to the given checkpoint, returning the number of transactions removed;
+	# see `qualia.journal.Journal.compact`.
+	def compact_journal(self, checkpoint_id):
+		self._require_read_write()
+
+		if self.journal.get_checkpoint(checkpoint_id) is None: raise common.CheckpointDoesNotExistError(checkpoint_id)
+
+		# This is committed immediately, so anything pending has to be committed first.
+		self.commit()
 
-	# Check to see whether a file exists. We do this using the searchdb rather than the existing
-	# files because the searchdb is more likely to be internally consistent.
+		return self.journal.compact(checkpoint_id)
+
+	# Retrieve all checkpoints (with transactions). `order` can be set to `'asc'` or `'desc'`, and
+	# only checkpoints from `since` on (up to `limit` of them) can be asked for.
+	def all_checkpoints(self, *, order = 'asc', since = None, limit = None):
+		return self.journal.all_checkpoints(order = order, since = since, limit = limit)
+
+	# Like `all_checkpoints`, but only gives the number of transactions of each op in each
+	# checkpoint, as `(checkpoint_id, counts, compacted)`; see
+	# `qualia.journal.Journal.checkpoint_summaries`.
+	def checkpoint_summaries(self, *, order = 'asc', since = None, limit = None):
+		return self.journal.checkpoint_summaries(order = order, since = since, limit = limit)
+
+	# Check to see whether a file exists. We do this using the hash index (which follows the
+	# searchdb) rather than the existing files because the searchdb is more likely to be internally
+	# consistent.
+	#
+	# Most files being checked are new, so the Bloom filter can usually answer without touching the
+	# hash index at all.
 	def exists(self, hash):
-		return self.searchdb.exists(hash)
+		if hash not in self.filter: return False
+
+		return self.hashindex.exists(hash)
+
+	# Returns a `dict` of statistics about the database and its indexes, for `qualia stats`.
+	def stats(self):
+		fill, false_positive_rate = self.filter.stats()
+
+		return {
+			'files': len(self.hashindex),
+			'hash-index-size': path.getsize(self.hashindex.filename) if path.exists(self.hashindex.filename) else 0,
+			'filter-size': self.filter.size // 8,
+			'filter-capacity': self.filter.capacity,
+			'filter-deleted': self.filter.deleted,
+			'filter-fill': fill,
+			'filter-false-positive-rate': false_positive_rate,
+			'duplicate-index-built': self.duplicates.built if self.duplicates else None,
+		}
@@ -0,0 +1,97 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+# 
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+# This is the duplicate index, which records the size and a hash of the beginning of every stored
+# file. This lets `Database.stage_file` notice likely duplicates before it copies anything, and only
+# hash those files in full.
+#
+# The index is purely advisory: a missing entry just means a duplicate is copied before being
+# rejected (as it would have been without the index), and a stale one costs an extra read of the
+# file. This means it doesn't have to be kept exactly in step with the journal and search index.
+#
+## Imports
+from .lazy_import import lazy_import
+
+lazy_import(globals(), """
+	import hashlib
+	import sqlite3
+	import threading
+""")
+
+## Constants
+# The number of bytes at the beginning of each file that go into its partial hash.
+PARTIAL_SIZE = 65536
+
+## Utility functions
+# Computes the partial hash for a file given (at least) its first `PARTIAL_SIZE` bytes. This is
+# independent of the database's hash scheme, as it never leaves the duplicate index.
+def partial_hash(data):
+	return hashlib.blake2b(data[:PARTIAL_SIZE], digest_size = 16).digest()
+
+## Duplicate index
+class DuplicateIndex:
+	def __init__(self, filename):
+		# Files are staged on several threads at once (see `qualia.conversion.stage_files`), so the
+		# connection is shared between them and protected by a lock.
+		self.db = sqlite3.connect(filename, check_same_thread = False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.lock = threading.Lock()
+
+		self.db.executescript('''
+			CREATE TABLE IF NOT EXISTS objects (
+				hash TEXT PRIMARY KEY,
+				size INTEGER,
+				partial BLOB
+			);
+			CREATE INDEX IF NOT EXISTS objects_size_partial ON objects(size, partial);
+		''')
+
+	# Whether this index has been filled in with all the files that were in the database before it
+	# was created. This is tracked with the `user_version`, which is only set once that is done (or
+	# straight away, for a database without any files).
+	@property
+	def built(self):
+		return self.db.execute('PRAGMA user_version').fetchone()[0] >= 1
+
+	def mark_built(self):
+		with self.lock:
+			self.db.execute('PRAGMA user_version = 1')
+			self.db.commit()
+
+	# Returns the set of stored hashes with the given size and partial hash.
+	def find(self, size, partial):
+		with self.lock:
+			return set(row[0] for row in self.db.execute('SELECT hash FROM objects WHERE size = ? AND partial = ?', (size, partial)))
+
+	def add(self, hash, size, partial):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO objects(hash, size, partial) VALUES(?, ?, ?)', (hash, size, partial))
+
+	def delete(self, hash):
+		with self.lock:
+			self.db.execute('DELETE FROM objects WHERE hash = ?', (hash,))
+
+	# Rewrites the hashes in `renames` (a mapping of old to new hashes) after a change of hash
+	# scheme.
+	def rename_files(self, renames):
+		with self.lock:
+			self.db.executemany('UPDATE objects SET hash = ? WHERE hash = ?', ((new, old) for old, new in renames.items()))
+			self.db.commit()
+
+	def commit(self):
+		with self.lock:
+			self.db.commit()
@@ -0,0 +1,315 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+# This is the hash index, a sorted array of the (binary) hashes of every file in the database. It
+# answers `exists`, prefix lookups and shortest unambiguous prefixes with a binary search over a
+# memory map, rather than a query against the search index.
+#
+# The index is made up of two files:
+#
+#   * `hashes` has a short header followed by every hash, in order.
+#   * `hashes.log` has the hashes added (`+`) and removed (`-`) since `hashes` was written, along
+#     with a `G` record at every commit giving the search index generation it matches. Changes
+#     after the last `G` record are ignored, as they were never committed.
+#
+# The log is read into memory when the index is opened, and folded into a new `hashes` file once it
+# gets large enough. If the index doesn't match the generation of the search index (if it's
+# missing, or a commit was interrupted), it's simply rebuilt from the search index.
+#
+## Imports
+from .lazy_import import lazy_import
+
+lazy_import(globals(), """
+	import bisect
+	import heapq
+	import mmap
+	import os
+	from os import path
+	import struct
+""")
+
+## Constants
+# The header of `hashes` is this magic number, then the width of each hash and the generation.
+MAGIC = b'QHI1'
+HEADER = struct.Struct('<4sIQ')
+GENERATION = struct.Struct('<Q')
+
+# The log is folded into `hashes` once it has more than this many changes, or more than an eighth
+# as many as there are hashes, whichever is larger.
+MIN_COMPACT_CHANGES = 65536
+
+## Utility functions
+# Returns the number of leading hex digits `a` and `b` have in common.
+def _common_prefix_length(a, b):
+	return len(path.commonprefix([a.hex(), b.hex()]))
+
+## Hash index
+class HashIndex:
+	def __init__(self, filename, width, read_only = False):
+		self.filename = filename
+		self.log_filename = filename + '.log'
+		self.width = width
+		self.read_only = read_only
+
+		self.map = None
+		self.count = 0
+		self.generation = None
+
+		# The hashes added since `hashes` was written are kept sorted, so they can be searched just
+		# like the memory map. `pending` has the uncommitted changes, which are written to the log
+		# by `commit`.
+		self.added = []
+		self.added_set = set()
+		self.removed = set()
+		self.pending = []
+
+		self._load()
+
+	def _load(self):
+		try:
+			with open(self.filename, 'rb') as f:
+				magic, width, generation = HEADER.unpack(f.read(HEADER.size))
+
+				if magic != MAGIC or width != self.width: return
+
+				size = os.fstat(f.fileno()).st_size
+				if size > HEADER.size:
+					self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+				self.count = (size - HEADER.size) // self.width
+				self.generation = generation
+		except (FileNotFoundError, struct.error):
+			return
+
+		try:
+			with open(self.log_filename, 'rb') as f:
+				log = f.read()
+		except FileNotFoundError:
+			return
+
+		changes = []
+		offset = 0
+
+		while offset < len(log):
+			op = log[offset:offset + 1]
+			offset += 1
+
+			if op == b'G':
+				if offset + GENERATION.size > len(log): break
+
+				for change in changes: self._apply(*change)
+				changes = []
+
+				self.generation, = GENERATION.unpack_from(log, offset)
+				offset += GENERATION.size
+			elif op in (b'+', b'-'):
+				if offset + self.width > len(log): break
+
+				changes.append((op, log[offset:offset + self.width]))
+				offset += self.width
+			else:
+				break
+
+	# Whether this index matches the given generation of the search index.
+	def is_current(self, generation):
+		return self.generation == generation
+
+	# Replaces the contents of the index with the given (hex) hashes, which match the given
+	# generation of the search index. In read-only mode, the new contents are only kept in memory.
+	def rebuild(self, hashes, generation):
+		self.added = sorted(bytes.fromhex(hash) for hash in hashes)
+		self.added_set = set(self.added)
+		self.removed = set()
+		self.pending = []
+
+		self.map = None
+		self.count = 0
+		self.generation = generation
+
+		if not self.read_only: self._compact()
+
+	### Base array
+	def _key(self, i):
+		start = HEADER.size + i * self.width
+
+		return self.map[start:start + self.width]
+
+	# Returns the position of the first hash in `hashes` that isn't less than `key`.
+	def _bisect(self, key):
+		lo, hi = 0, self.count
+
+		while lo < hi:
+			mid = (lo + hi) // 2
+
+			if self._key(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+
+		return lo
+
+	def _base_contains(self, key):
+		i = self._bisect(key)
+
+		return i < self.count and self._key(i) == key
+
+	def _base_keys(self, start = 0):
+		for i in range(start, self.count):
+			yield self._key(i)
+
+	### Changes
+	def _apply(self, op, key):
+		if op == b'+':
+			if key in self.removed:
+				self.removed.discard(key)
+			elif key not in self.added_set and not self._base_contains(key):
+				bisect.insort(self.added, key)
+				self.added_set.add(key)
+		else:
+			if key in self.added_set:
+				self.added.remove(key)
+				self.added_set.discard(key)
+			elif self._base_contains(key):
+				self.removed.add(key)
+
+	def add(self, hash):
+		key = bytes.fromhex(hash)
+		self._apply(b'+', key)
+		self.pending.append(b'+' + key)
+
+	def delete(self, hash):
+		key = bytes.fromhex(hash)
+		self._apply(b'-', key)
+		self.pending.append(b'-' + key)
+
+	# Writes out any changes, recording that the index now matches the given generation of the
+	# search index.
+	def commit(self, generation):
+		if self.read_only or (not self.pending and generation == self.generation): return
+
+		self.generation = generation
+
+		if len(self.added) + len(self.removed) > max(MIN_COMPACT_CHANGES, self.count // 8):
+			self._compact()
+			return
+
+		with open(self.log_filename, 'ab') as f:
+			f.write(b''.join(self.pending) + b'G' + GENERATION.pack(generation))
+			f.flush()
+			os.fsync(f.fileno())
+
+		self.pending = []
+
+	# Writes a new `hashes` file with all the changes folded in, then empties the log.
+	def _compact(self):
+		keys = heapq.merge((key for key in self._base_keys() if key not in self.removed), self.added)
+		new_filename = self.filename + '.new'
+		count = 0
+
+		try:
+			with open(new_filename, 'wb') as f:
+				f.write(HEADER.pack(MAGIC, self.width, self.generation))
+
+				for key in keys:
+					f.write(key)
+					count += 1
+
+				f.flush()
+				os.fsync(f.fileno())
+		except:
+			os.unlink(new_filename)
+			raise
+
+		os.replace(new_filename, self.filename)
+
+		try:
+			os.unlink(self.log_filename)
+		except FileNotFoundError:
+			pass
+
+		self.map = None
+		self.count = count
+		self.added = []
+		self.added_set = set()
+		self.removed = set()
+		self.pending = []
+
+		if count:
+			with open(self.filename, 'rb') as f:
+				self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+	### Lookups
+	def __len__(self):
+		return self.count - len(self.removed) + len(self.added)
+
+	def exists(self, hash):
+		try:
+			key = bytes.fromhex(hash)
+		except ValueError:
+			return False
+
+		if key in self.added_set: return True
+
+		return key not in self.removed and self._base_contains(key)
+
+	# Yields all the (hex) hashes starting with the given (hex) prefix, in order.
+	def find(self, prefix):
+		padding = self.width * 2 - len(prefix)
+		if padding < 0: return
+
+		low = bytes.fromhex(prefix + '0' * padding)
+		high = bytes.fromhex(prefix + 'f' * padding)
+
+		def _base():
+			for key in self._base_keys(self._bisect(low)):
+				if key > high: break
+				if key not in self.removed: yield key
+
+		start, end = bisect.bisect_left(self.added, low), bisect.bisect_right(self.added, high)
+
+		for key in heapq.merge(_base(), self.added[start:end]):
+			yield key.hex()
+
+	# Returns the hashes just before and after the given hash (which may not be in the index), or
+	# `None` for either if there isn't one.
+	def _neighbours(self, key):
+		before = after = None
+
+		i = self._bisect(key)
+		j = i - 1
+
+		if i < self.count and self._key(i) == key: i += 1
+		while i < self.count and self._key(i) in self.removed: i += 1
+		while j >= 0 and self._key(j) in self.removed: j -= 1
+
+		if i < self.count: after = self._key(i)
+		if j >= 0: before = self._key(j)
+
+		k = bisect.bisect_left(self.added, key)
+		l = k - 1
+		if k < len(self.added) and self.added[k] == key: k += 1
+
+		if k < len(self.added) and (after is None or self.added[k] < after): after = self.added[k]
+		if l >= 0 and (before is None or self.added[l] > before): before = self.added[l]
+
+		return before, after
+
+	# Returns the number of leading hex digits of the given hash that no other hash shares.
+	def unique_prefix_length(self, hash):
+		key = bytes.fromhex(hash)
+
+		return max([_common_prefix_length(key, other) for other in self._neighbours(key) if other is not None] + [0]) + 1
@@ -19,18 +19,140 @@
 #
 ## Imports
 from .lazy_import import lazy_import
+from . import config
 
 lazy_import(globals(), """
 	import datetime
+	import itertools
 	import pickle
 	import sqlite3
 """)
 
+## Constants
+# `Journal.append` writes out the transactions it's given once it has this many.
+APPEND_BUFFER_SIZE = 1000
+
+# The number of old transactions `Journal.commit` converts to the current format each time (see
+# `Journal.migrate_extra`).
+MIGRATION_BATCH_SIZE = 1000
+
+## Queries
+# These lookups are done for every file or checkpoint that's looked at, so they have to use an
+# index to stay fast as the journal grows; `Journal.query_plans` shows whether they do.
+#
+# The history of a single file (`{history}` is `Journal.history`).
+TRANSACTIONS_BY_FILE = '''
+	SELECT
+		*
+		FROM {history}
+		WHERE file = ? AND op = ?
+		ORDER BY serial
+'''
+
+# The transactions in a range of serials, such as those of a checkpoint.
+TRANSACTIONS_BY_SERIAL = '''
+	SELECT
+		*
+		FROM journal
+		WHERE serial > ? AND serial <= ?
+		ORDER BY serial
+'''
+
+# The serial of the latest checkpoint.
+LATEST_CHECKPOINT_SERIAL = 'SELECT MAX(serial) FROM checkpoints'
+
+## Encoding
+# The extra arguments of a `set` (the field, old value and new value) are stored in typed columns of
+# their own, so SQLite can filter by field, and reading a transaction back takes no more than a
+# tuple. `add`s and `delete`s don't have any extra arguments.
+#
+# SQLite can store `None`, strings, floats and 64-bit integers as they are. Anything else is
+# stored as one of these, with a one-letter tag in `value_types` (one for the old value, then one for
+# the new value, or `NULL` if neither has one) saying how to convert it back:
+#
+#   * `B`: a boolean, as 0 or 1.
+#   * `I`: an integer too large for 64 bits, as its decimal digits.
+#   * `D`: a datetime, in ISO 8601 format (with its timezone, if it has one).
+#   * `d`: a date, in ISO 8601 format.
+#   * `S`: a string that isn't valid UTF-8 (such as a filename with lone surrogates), as a blob.
+#
+# Transactions from before these columns existed have a pickle of their arguments in `extra`
+# instead, until `Journal.migrate_extra` converts them.
+_VALUE_DECODERS = {
+	'-': lambda value: value,
+	'B': bool,
+	'I': int,
+	'D': lambda value: datetime.datetime.fromisoformat(value),
+	'd': lambda value: datetime.date.fromisoformat(value),
+	'S': lambda value: value.decode('utf-8', 'surrogatepass'),
+}
+
+# Returns the given value as SQLite can store it, and its tag (`-` if it's stored as it is).
+def _encode_value(value):
+	if value is None or isinstance(value, float):
+		return value, '-'
+	elif isinstance(value, str):
+		if value.isascii(): return value, '-'
+
+		try:
+			value.encode('utf-8')
+			return value, '-'
+		except UnicodeEncodeError:
+			return value.encode('utf-8', 'surrogatepass'), 'S'
+	elif isinstance(value, bool):
+		return int(value), 'B'
+	elif isinstance(value, int):
+		return (value, '-') if -2 ** 63 <= value < 2 ** 63 else (str(value), 'I')
+	elif isinstance(value, datetime.datetime):
+		return value.isoformat(), 'D'
+	elif isinstance(value, datetime.date):
+		return value.isoformat(), 'd'
+
+	raise TypeError('cannot store a value of type {} in the journal'.format(type(value).__name__))
+
+# Returns the `field`, `old_value`, `new_value` and `value_types` columns for the given extra
+# arguments, which have to be either empty or those of a `set`.
+def _encode_extra(args):
+	if not args: return None, None, None, None
+
+	field, old_value, new_value = args
+	old_value, old_type = _encode_value(old_value)
+	new_value, new_type = _encode_value(new_value)
+	value_types = old_type + new_type
+
+	return field, old_value, new_value, None if value_types == '--' else value_types
+
+# Returns the extra arguments of the transaction in the given row.
+def _decode_extra(row):
+	if row['extra'] is not None: return pickle.loads(row['extra'])
+	if row['field'] is None: return ()
+
+	old_value, new_value, value_types = row['old_value'], row['new_value'], row['value_types']
+
+	if value_types is not None:
+		old_value = _VALUE_DECODERS[value_types[0]](old_value)
+		new_value = _VALUE_DECODERS[value_types[1]](new_value)
+
+	return row['field'], old_value, new_value
+
+# Returns the transaction in the given row as a `dict`, in the form that the journal's methods
+# return them.
+def _transaction(row):
+	return {
+		'serial': row['serial'],
+		'timestamp': row['timestamp'],
+		'source': row['source'],
+		'file': row['file'],
+		'op': row['op'],
+		'extra': _decode_extra(row),
+	}
+
 ## Journal
 # The journal is implemented on top of a simple SQLite database, which gives us a convenient
 # datastore and good disaster resilience.
 class Journal:
 	def __init__(self, filename, read_only = False):
+		self.read_only = read_only
 		self.db = sqlite3.connect(
 			'file:' + filename + ('?mode=ro' if read_only else ''),
 			uri = True,
@@ -42,6 +164,11 @@ class Journal:
 		# [the SQLite documentation](https://www.sqlite.org/wal.html) for more info.
 		self.db.execute('PRAGMA journal_mode=WAL');
 
+		# These trade off durability and memory use against speed; see the `journal-*` options.
+		self.db.execute('PRAGMA synchronous = {}'.format(config.conf.get('journal-synchronous', 'full').upper()))
+		self.db.execute('PRAGMA cache_size = {:d}'.format(-config.conf.get('journal-cache-size', 2048)))
+		self.db.execute('PRAGMA mmap_size = {:d}'.format(config.conf.get('journal-mmap-size', 0) * 1024 * 1024))
+
 		# This replaces the usual tuple format for rows with a convenient dict-like object.
 		self.db.row_factory = sqlite3.Row
 		self.upgrade_if_needed()
@@ -49,6 +176,9 @@ class Journal:
 		# This indicates whether there have been changes since the last checkpoint.
 		self.has_changes = False
 
+		# New transactions are held here until they're written out by `flush`.
+		self.pending = []
+
 	def upgrade_if_needed(self):
 		# We check the version of the database and upgrade it if necessary.
 		# Conveniently, this starts at 0 in an empty database.
@@ -71,43 +201,269 @@ class Journal:
 					timestamp TIMESTAMP,
 					serial INTEGER
 				);
+			""",
+			# These let the history of a single file (for `restore_metadata`) and the latest checkpoint
+			# (for `commit` and `qualia gc`) be found without scanning the whole journal.
+			"""
+				CREATE INDEX journal_file_op_serial ON journal(file, op, serial);
+				CREATE INDEX checkpoints_serial ON checkpoints(serial);
+			""",
+			# The extra arguments of each transaction are stored in typed columns (see `_encode_extra`).
+			# Older, pickled transactions are converted a batch at a time by `migrate_extra`, which
+			# records how far it's got in `extra_migration`.
+			"""
+				ALTER TABLE journal ADD COLUMN field TEXT;
+				ALTER TABLE journal ADD COLUMN old_value;
+				ALTER TABLE journal ADD COLUMN new_value;
+				ALTER TABLE journal ADD COLUMN value_types TEXT;
+
+				CREATE TABLE extra_migration (
+					done INTEGER,
+					until INTEGER
+				);
+
+				INSERT INTO extra_migration(done, until) SELECT 0, IFNULL(MAX(serial), 0) FROM journal;
+			""",
+			# `compact` moves the latest `set` of each field of each file (by each source) before a
+			# given point here, and records that point in `compaction`. (Only converted transactions are
+			# moved, so this has no `extra`.)
 			"""
+				CREATE TABLE snapshot (
+					serial INTEGER,
+					timestamp TIMESTAMP,
+					source TEXT,
+					file TEXT,
+					op TEXT,
+					field TEXT,
+					old_value,
+					new_value,
+					value_types TEXT,
+					PRIMARY KEY (file, field, source)
+				);
+
+				CREATE TABLE compaction (
+					serial INTEGER
+				);
+
+				INSERT INTO compaction(serial) VALUES(0);
+			""",
+			# The generation of the search index as of the latest commit, which is committed along with
+			# the checkpoint (see `commit` and `qualia.search.SearchDatabase._recover`).
+			"""
+				CREATE TABLE search_checkpoint (
+					generation INTEGER
+				);
+
+				INSERT INTO search_checkpoint(generation) VALUES(NULL);
+			""",
 		]
 
+		# The history of each file is in both the journal and the snapshot, if there is one (see
+		# `compact`).
+		#
+		# (The snapshot has no `extra`. A plain `NULL` in its place would stop SQLite from using the
+		# indexes of both tables through the `UNION`, but one with a type doesn't.)
+		self.history = 'journal'
+		if version >= 5 or not self.read_only:
+			self.history = '''(
+				SELECT serial, timestamp, source, file, op, extra, field, old_value, new_value, value_types FROM journal
+				UNION ALL
+				SELECT serial, timestamp, source, file, op, CAST(NULL AS BLOB), field, old_value, new_value, value_types FROM snapshot
+			)'''
+
+		# A read-only journal can't be upgraded, but can still be read (if more slowly) as long as
+		# it has all the tables.
+		self.version = version
+		if self.read_only and version >= 2: return
+
 		# We set the `user_version` after each update to ensure updates are not applied twice if one
 		# in a sequence of updates fails.
 		for version, update in enumerate(updates[version:], version + 1):
 			self.db.executescript(update)
 			self.db.execute("PRAGMA user_version = {}".format(version))
+
+		self.version = len(updates)
 	
-	# Appends a new entry to the journal. Any extra args are usually specific to the given `op`, and
-	# will be pickled before storage.
+	# Appends a new entry to the journal. Any extra args are those of a `set` (the field, old value
+	# and new value), and are stored as described in `_encode_extra`.
+	#
+	# Entries are buffered, and written out together by `flush` (which is done automatically
+	# before anything reads the journal).
 	def append(self, source, file, op, *args, time = None):
-		cur = self.db.cursor()
-		cur.execute('''
+		self.pending.append((time or datetime.datetime.now(), source, file, op) + _encode_extra(args))
+		self.has_changes = True
+
+		if len(self.pending) >= APPEND_BUFFER_SIZE: self.flush()
+
+	# Writes out any buffered entries. Like single entries, these are only committed by `commit`.
+	def flush(self):
+		if not self.pending: return
+
+		self.db.executemany('''
 			INSERT INTO
-				journal(timestamp, source, file, op, extra)
-				VALUES(?, ?, ?, ?, ?)
+				journal(timestamp, source, file, op, field, old_value, new_value, value_types)
+				VALUES(?, ?, ?, ?, ?, ?, ?, ?)
 			''',
-			(time or datetime.datetime.now(), source, file, op, pickle.dumps(args))
+			self.pending
 		)
-		self.has_changes = True
+		self.pending = []
 
-	# Returns all matching transactions for a given file and op.
+	# Returns all matching transactions for a given file and op. If the journal has been compacted,
+	# only the latest `set` of each field (by each source) from before that point is left.
 	def get_transactions(self, file, op):
+		self.flush()
+
 		cur = self.db.cursor()
-		cur.execute('''
+		cur.execute(TRANSACTIONS_BY_FILE.format(history = self.history), (file, op))
+
+		for row in cur.fetchall():
+			yield _transaction(row)
+
+	# Yields `(file, transactions)` for every file in the journal, with each file's transactions in
+	# order. Only one file's transactions are held in memory at a time. Like `get_transactions`, this
+	# includes the snapshot left by `compact`.
+	def all_transactions_by_file(self):
+		self.flush()
+
+		cur = self.db.execute('''
 			SELECT
 				*
+				FROM {}
+				ORDER BY file, serial
+		'''.format(self.history))
+
+		rows = (_transaction(row) for row in cur)
+
+		for file, transactions in itertools.groupby(rows, key = lambda t: t['file']):
+			yield file, list(transactions)
+
+	# Returns the sorted list of files deleted after the given serial (and before the latest
+	# checkpoint), along with the serial of that checkpoint.
+	def get_deleted_files(self, after):
+		self.flush()
+
+		last_serial = self.db.execute(LATEST_CHECKPOINT_SERIAL).fetchone()[0] or 0
+
+		rows = self.db.execute('''
+			SELECT
+				DISTINCT file
 				FROM journal
-				WHERE file = ? AND op = ?
-				ORDER BY serial
+				WHERE op = 'delete' AND serial > ? AND serial <= ?
+				ORDER BY file
 			''',
-			(file, op)
-		)
+			(after, last_serial)
+		).fetchall()
 
-		for row in cur.fetchall():
-			yield dict(row, extra = pickle.loads(row['extra']))
+		return [row[0] for row in rows], max(last_serial, after)
+
+	# Rewrites every reference to the hashes in `renames` (a mapping of old to new hashes), for when
+	# the database changes hash schemes. This is committed immediately, and does a single pass over
+	# the journal no matter how many files are renamed.
+	def rename_files(self, renames):
+		self.flush()
+
+		with self.db:
+			self.db.execute('CREATE TEMPORARY TABLE renames (old TEXT PRIMARY KEY, new TEXT)')
+			self.db.executemany('INSERT INTO renames(old, new) VALUES(?, ?)', renames.items())
+			self.db.execute('''
+				UPDATE journal
+					SET file = (SELECT new FROM renames WHERE old = journal.file)
+					WHERE file IN (SELECT old FROM renames)
+			''')
+			self.db.execute('''
+				UPDATE snapshot
+					SET file = (SELECT new FROM renames WHERE old = snapshot.file)
+					WHERE file IN (SELECT old FROM renames)
+			''')
+			self.db.execute('DROP TABLE renames')
+
+	# Returns `(name, plan, uses_indexes)` for each of the lookups above, where `plan` is the list of
+	# steps SQLite's `EXPLAIN QUERY PLAN` gives for it. A lookup that has to scan a whole table
+	# (usually because an index is missing) doesn't use indexes.
+	def query_plans(self):
+		lookups = [
+			('transactions by file', TRANSACTIONS_BY_FILE.format(history = self.history), ('', 'set')),
+			('transactions by serial', TRANSACTIONS_BY_SERIAL, (0, 0)),
+			('latest checkpoint', LATEST_CHECKPOINT_SERIAL, ()),
+		]
+
+		for name, query, args in lookups:
+			plan = [row['detail'] for row in self.db.execute('EXPLAIN QUERY PLAN ' + query, args)]
+
+			# (SQLite can also report a `SEARCH` without an index for `MAX`, which is still a scan.)
+			yield name, plan, not any(step.startswith('SCAN ') or (step.startswith('SEARCH ') and ' USING ' not in step) for step in plan)
+
+	# Returns the serial up to which the journal has been compacted, or 0. Checkpoints up to this
+	# serial may be missing some of their transactions.
+	def compacted_serial(self):
+		if self.history == 'journal': return 0
+
+		return self.db.execute('SELECT serial FROM compaction').fetchone()[0]
+
+	# Returns the generation of the search index recorded by the latest `commit`, or `None`.
+	def search_generation(self):
+		if self.version < 6: return None
+
+		return self.db.execute('SELECT generation FROM search_checkpoint').fetchone()[0]
+
+	# Compacts all the transactions before the given checkpoint, so that the journal doesn't keep
+	# growing with every change. Returns the number of transactions discarded (not counting those
+	# kept in the snapshot).
+	#
+	# The `add`s and `delete`s are left alone (as they're few, and `qualia gc` needs the latter), but
+	# only the latest `set` of each field of each file (by each source) is kept, in the snapshot.
+	# Everything that reads the history of a file (like `restore_metadata` and `qualia reindex`)
+	# then gets the same result as before, but checkpoints before that point can no longer be
+	# undone.
+	#
+	# This is committed immediately. Any transactions that haven't been converted yet are converted
+	# first (see `migrate_extra`), so the snapshot only holds typed columns; the few that can't be are
+	# left in the journal.
+	def compact(self, checkpoint_id):
+		self.flush()
+		for _ in self.migrate_extra(): pass
+
+		previous = self.db.execute('''
+			SELECT
+				serial
+				FROM checkpoints
+				WHERE checkpoint_id < ?
+				ORDER BY checkpoint_id DESC
+				LIMIT 1
+			''',
+			(checkpoint_id,)
+		).fetchone()
+
+		start, end = self.compacted_serial(), previous[0] if previous else 0
+		if end <= start: return 0
+
+		snapshot_before = self.db.execute('SELECT COUNT(*) FROM snapshot').fetchone()[0]
+
+		with self.db:
+			# As the rows are in order, later `set`s replace earlier ones in the snapshot.
+			self.db.execute('''
+				INSERT OR REPLACE INTO
+					snapshot(serial, timestamp, source, file, op, field, old_value, new_value, value_types)
+					SELECT
+						serial, timestamp, source, file, op, field, old_value, new_value, value_types
+						FROM journal
+						WHERE serial > ? AND serial <= ? AND op = 'set' AND extra IS NULL
+						ORDER BY serial
+				''',
+				(start, end)
+			)
+			removed = self.db.execute('''
+				DELETE
+					FROM journal
+					WHERE serial > ? AND serial <= ? AND op = 'set' AND extra IS NULL
+				''',
+				(start, end)
+			).rowcount
+			self.db.execute('UPDATE compaction SET serial = ?', (end,))
+
+		# Whatever was removed from the journal and didn't end up in the snapshot (or replaced a
+		# row there) is gone.
+		return removed + snapshot_before - self.db.execute('SELECT COUNT(*) FROM snapshot').fetchone()[0]
 
 	# Sets a checkpoint at the current journal point. This groups all the transactions since the
 	# last checkpoint into one operation and marks them as completely applied to the other
@@ -115,10 +471,21 @@ class Journal:
 	#
 	# If no transactions have been done since the last checkpoint, no checkpoint will be created and
 	# this method will return `None`.
-	def commit(self, time = None):
-		if not self.has_changes: return None
-
+	#
+	# If given, `search_generation` is recorded in the same transaction, so it's only kept if the
+	# checkpoint is.
+	def commit(self, time = None, search_generation = None):
 		cur = self.db.cursor()
+
+		if search_generation is not None:
+			cur.execute('UPDATE search_checkpoint SET generation = ? WHERE generation IS NOT ?', (search_generation, search_generation))
+
+		if not self.has_changes:
+			self.db.commit()
+			return None
+
+		self.flush()
+
 		cur.execute('''
 			INSERT INTO
 				checkpoints(timestamp, serial)
@@ -127,12 +494,68 @@ class Journal:
 			(time or datetime.datetime.now(),)
 		)
 		self.db.commit()
+		self.has_changes = False
+
+		# Older transactions are converted a little at a time, so no single commit takes long.
+		next(self.migrate_extra(MIGRATION_BATCH_SIZE), None)
 
 		return cur.lastrowid
 
+	# Converts pickled transactions from before the typed columns existed, `batch_size` at a time,
+	# yielding the number looked at so far after each batch. Each batch is committed on its own, so
+	# this can be stopped at any point and picks up where it left off.
+	#
+	# A transaction with a value that can't be stored in the columns (see `_encode_value`) is left
+	# pickled, and is still read as before.
+	def migrate_extra(self, batch_size = 10000):
+		if self.read_only: return
+
+		converted = 0
+
+		while True:
+			done, until = self.db.execute('SELECT done, until FROM extra_migration').fetchone()
+			if done >= until: return
+
+			rows = self.db.execute('''
+				SELECT
+					serial, extra
+					FROM journal
+					WHERE serial > ? AND serial <= ?
+					ORDER BY serial
+					LIMIT ?
+				''',
+				(done, until, batch_size)
+			).fetchall()
+
+			end = rows[-1]['serial'] if rows else until
+			updates = []
+
+			for row in rows:
+				if row['extra'] is None: continue
+
+				try:
+					updates.append(_encode_extra(pickle.loads(row['extra'])) + (row['serial'],))
+				except (TypeError, ValueError):
+					pass
+
+			with self.db:
+				self.db.executemany('''
+					UPDATE journal
+						SET extra = NULL, field = ?, old_value = ?, new_value = ?, value_types = ?
+						WHERE serial = ?
+					''',
+					updates
+				)
+				self.db.execute('UPDATE extra_migration SET done = ?', (end,))
+
+			converted += len(rows)
+			yield converted
+
 	# Retrieves the given checkpoint and its transactions. (If `None`, retrieves the latest
 	# transaction.) 
 	def get_checkpoint(self, checkpoint_id):
+		self.flush()
+
 		if checkpoint_id is None:
 			checkpoint = self.db.execute('''
 					SELECT
@@ -166,22 +589,92 @@ class Journal:
 		checkpoint = dict(checkpoint)
 		checkpoint.update(
 			transactions = [
-				dict(row, extra = pickle.loads(row['extra']))
+				_transaction(row)
 				for row in
-				self.db.execute('''
-					SELECT *
-						FROM journal
-						WHERE serial > ? AND serial <= ?
-						ORDER BY serial
-					''',
-					(last_checkpoint[0] if last_checkpoint else 0, checkpoint['serial'])
-				).fetchall()
+				self.db.execute(TRANSACTIONS_BY_SERIAL, (last_checkpoint[0] if last_checkpoint else 0, checkpoint['serial'])).fetchall()
 			]
 		)
 
 		return checkpoint
 
-	# Retrieves the IDs of all checkpoints in the given order (`'asc'` or `'desc'`).
-	def all_checkpoint_ids(self, *, order = 'asc'):
-		for row in self.db.execute('SELECT checkpoint_id FROM checkpoints ORDER BY checkpoint_id ' + ('DESC' if order == 'desc' else 'ASC')).fetchall():
-			yield row[0]
+	# The checkpoints (in the given order) with an ID of at least `since`, up to `limit` of them,
+	# along with the serial they start after. This is used as the first part of the queries below.
+	def _checkpoints_query(self, order):
+		return '''
+			WITH selected AS (
+				SELECT
+					*,
+					IFNULL((
+						SELECT
+							serial
+							FROM checkpoints AS previous
+							WHERE previous.checkpoint_id < checkpoints.checkpoint_id
+							ORDER BY previous.checkpoint_id DESC
+							LIMIT 1
+					), 0) AS start
+					FROM checkpoints
+					WHERE checkpoint_id >= ?
+					ORDER BY checkpoint_id {0}
+					LIMIT ?
+			)
+		'''.format('DESC' if order == 'desc' else 'ASC')
+
+	# Yields `(checkpoint_id, counts, compacted)` for each checkpoint (see `_checkpoints_query`),
+	# where `counts` gives the number of transactions of each op, and `compacted` is set if some of
+	# them may have been moved into the snapshot by `compact` (and so aren't counted). This is all
+	# done in one query.
+	def checkpoint_summaries(self, *, order = 'asc', since = None, limit = None):
+		self.flush()
+
+		compacted_serial = self.compacted_serial()
+
+		cur = self.db.execute(self._checkpoints_query(order) + '''
+			SELECT
+				selected.checkpoint_id, selected.serial, journal.op, COUNT(journal.serial)
+				FROM selected
+				LEFT JOIN journal ON journal.serial > selected.start AND journal.serial <= selected.serial
+				GROUP BY selected.checkpoint_id, journal.op
+				ORDER BY selected.checkpoint_id {}
+			'''.format('DESC' if order == 'desc' else 'ASC'),
+			(since or 0, -1 if limit is None else limit)
+		)
+
+		for (checkpoint_id, serial), rows in itertools.groupby(cur, key = lambda row: (row[0], row[1])):
+			yield checkpoint_id, {op: count for _, _, op, count in rows if op is not None}, serial <= compacted_serial
+
+	# Yields every checkpoint (see `_checkpoints_query`) with its transactions, just like
+	# `get_checkpoint`. This reads through the journal once with a single query, so only one
+	# checkpoint is held in memory at a time.
+	def all_checkpoints(self, *, order = 'asc', since = None, limit = None):
+		self.flush()
+
+		cur = self.db.execute(self._checkpoints_query(order) + '''
+			SELECT
+				selected.checkpoint_id AS checkpoint_id,
+				selected.timestamp AS checkpoint_timestamp,
+				selected.serial AS checkpoint_serial,
+				journal.*
+				FROM selected
+				LEFT JOIN journal ON journal.serial > selected.start AND journal.serial <= selected.serial
+				ORDER BY selected.checkpoint_id {}, journal.serial
+			'''.format('DESC' if order == 'desc' else 'ASC'),
+			(since or 0, -1 if limit is None else limit)
+		)
+
+		for checkpoint_id, rows in itertools.groupby(cur, key = lambda row: row['checkpoint_id']):
+			first = next(rows)
+			transactions = []
+
+			checkpoint = {
+				'checkpoint_id': checkpoint_id,
+				'timestamp': first['checkpoint_timestamp'],
+				'serial': first['checkpoint_serial'],
+				'transactions': transactions,
+			}
+
+			# Checkpoints without any transactions still have one row, with no transaction in it.
+			for row in itertools.chain([first], rows):
+				if row['serial'] is not None:
+					transactions.append(_transaction(row))
+
+			yield checkpoint
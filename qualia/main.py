@@ -25,11 +25,11 @@ import pkg_resources
 import sys
 
 lazy_import(globals(), """
-	import collections
 	import functools
 	import os
 	import tempfile
 	import shutil
+	import time
 """)
 
 ## Utility functions
@@ -75,22 +75,35 @@ OUTPUT_FORMATS = ['filename', 'short_hash', 'hash', 'long']
 ### `add`/`take`
 @auto_checkpoint
 def command_add(db, args):
-	for sf in args.file:
+	move = args.command == 'take'
+
+	for sf, staged, f in conversion.stage_files(db, args.file, move = move, jobs = args.jobs, link = args.link):
+		if isinstance(staged, OSError):
+			error('{}: could not be added: {}', sf.name, staged.strerror)
+			continue
+
 		try:
-			f = db.add_file(sf, args.command == 'take')
-			conversion.auto_add_metadata(f, sf.name)
+			db.add_staged(staged, move, link = args.link)
 			if args.restore: db.restore_metadata(f)
 			db.save(f)
 			print('{}: {}'.format(sf.name, f.short_hash))
 		except common.FileExistsError: error('{}: identical file in database, not added', sf.name)
 
+command_take = command_add
+
+### `count`
+def command_count(db, args):
+	print(db.count(' '.join(args.query)))
+
 ### `delete`/`rm`
 @auto_checkpoint
 def command_delete(db, args):
-	for hash in args.hash:
-		try:
-			db.delete(db.get(hash))
-		except common.FileDoesNotExistError: error('{}: does not exist', hash)
+	for hash, f in zip(args.hash, db.get_many(args.hash, return_errors = True)):
+		if isinstance(f, common.FileDoesNotExistError): error('{}: does not exist', hash)
+		elif isinstance(f, Exception): raise f
+		else: db.delete(f)
+
+command_rm = command_delete
 
 ### `dump metadata`
 def subcommand_dump_journal(db, args):
@@ -172,26 +185,167 @@ def command_find_hashes(db, args):
 	for hash in db.find_hashes(args.prefix):
 		print(hash)
 
+### `gc`
+def command_gc(db, args):
+	removed = 0
+
+	for removed in db.collect_garbage(jobs = args.jobs, batch_size = args.batch_size):
+		if args.verbose: print('removed {} files'.format(removed))
+
+	print('removed {} deleted files'.format(removed))
+
 ### `import`
 def command_import(db, args):
 	conversion.import_(db, args.file, renames = dict(args.rename or []))
 
+### `journal compact`
+def subcommand_journal_compact(db, args):
+	try:
+		discarded = db.compact_journal(args.before)
+		print('discarded {} superseded journal entries'.format(discarded))
+
+		return 0
+	except common.CheckpointDoesNotExistError: error('checkpoint {}: does not exist', args.before)
+
+	return 1
+
 ### `log`
 def command_log(db, args):
-	for checkpoint in db.all_checkpoints(order = 'desc'):
-		print('#{}: '.format(checkpoint['checkpoint_id']), end = '')
+	for checkpoint_id, types, compacted in db.checkpoint_summaries(order = 'desc', since = args.since, limit = args.limit):
+		summary = ['{} "{}"'.format(types[t], t) for t in sorted(types.keys())]
+
+		# The `set`s of compacted checkpoints are only kept in the snapshot, so they can't be counted.
+		if compacted: summary.append('compacted')
+
+		print('#{}: {}'.format(checkpoint_id, ', '.join(summary)))
+
+### `maintenance health`
+def subcommand_maintenance_health(db, args):
+	health = db.index_health()
+	documents = sum(segment['documents'] for segment in health['segments'])
+	deleted = sum(segment['deleted'] for segment in health['segments'])
+
+	print('segments: {}'.format(len(health['segments'])))
+	print('documents: {} ({} deleted, {:.1%})'.format(documents, deleted, deleted / documents if documents else 0))
+	print('size: {} bytes'.format(health['size']))
+	print('fields:')
+
+	for field in sorted(health['fields']):
+		print('    {}: {terms} terms, {postings} postings, {size} bytes of terms and postings'.format(field, **health['fields'][field]))
+
+	# The journal's lookups are checked too, as they slow down with its size if they can't use an
+	# index.
+	print('journal lookups:')
+	return_code = 0
+
+	for name, plan, uses_indexes in db.journal_query_plans():
+		print('    {}: {}'.format(name, '; '.join(plan)))
+
+		if not uses_indexes:
+			error('journal lookup `{}` scans a whole table instead of using an index', name)
+			return_code = 1
+
+	return return_code
+
+### `maintenance optimize`
+def subcommand_maintenance_optimize(db, args):
+	for merged, total in db.optimize_index():
+		print('merged {} of {} segments'.format(merged, total))
+
+### `maintenance rebuild-duplicates`
+def subcommand_maintenance_rebuild_duplicates(db, args):
+	for indexed, total in db.rebuild_duplicates():
+		print('indexed {} of {} files'.format(indexed, total))
+
+### `migrate-hash`
+def command_migrate_hash(db, args):
+	count = db.migrate_hash(args.scheme, jobs = args.jobs)
+	print('rehashed {} files with {}'.format(count, args.scheme))
+
+### `migrate-journal`
+def command_migrate_journal(db, args):
+	converted = 0
+
+	for converted in db.migrate_journal(batch_size = args.batch_size):
+		print('converted {} journal entries'.format(converted))
+
+	if not converted: print('journal is up to date')
+
+### `migrate-layout`
+def command_migrate_layout(db, args):
+	try:
+		for moved in db.migrate_layout(args.depth, batch_size = args.batch_size):
+			print('moved {} files'.format(moved))
+
+		return 0
+	except common.MigrationInProgressError as e: error('a migration to depth {} is unfinished; run it again first', e.args[0])
+	except ValueError: error('depth must be between 1 and {}', database.MAX_LAYOUT_DEPTH)
+
+	return 1
+
+### `repack`
+def command_repack(db, args):
+	before, after = db.repack()
+	print('rewrote {} packs into {}'.format(before, after))
+
+### `rebuild-filter`
+def command_rebuild_filter(db, args):
+	db.rebuild_filter()
+	print('rebuilt filter with {} files'.format(db.stats()['files']))
 
-		types = collections.defaultdict(lambda: 0)
+### `reindex`
+def command_reindex(db, args):
+	start = time.monotonic()
+	indexed = 0
 
-		for transaction in checkpoint['transactions']:
-			types[transaction['op']] += 1
+	for indexed, total in db.reindex(jobs = args.jobs):
+		print('indexed {} of {} files'.format(indexed, total))
 
-		print(', '.join('{} "{}"'.format(types[t], t) for t in sorted(types.keys())))
+	elapsed = time.monotonic() - start
+	print('reindexed {} files in {:.1f}s ({:.0f} files/s)'.format(indexed, elapsed, indexed / elapsed if elapsed else 0))
 
 ### `search`
 def command_search(db, args):
-	for result in db.search(' '.join(args.query), limit = args.limit):
-		show_file(db, result, args)
+	query = ' '.join(args.query)
+
+	try:
+		if args.facet:
+			counts = db.facet(query, args.facet)
+
+			for value in sorted(counts, key = lambda value: (-counts[value], str(value))):
+				print('{}: {}'.format(value, counts[value]))
+
+			return
+
+		sort, reverse = args.sort or (None, False)
+		limit = args.page_size or args.limit
+
+		# Unlimited results are streamed in the order they're stored, so there are no pages.
+		if not limit and (args.page != 1 or args.cursor is not None):
+			error('--page and --cursor need a limit')
+			return 1
+
+		# Only the long format needs anything more than the hash of each result.
+		if args.format == 'long':
+			results = ((f.cursor, f) for f in db.search(query, limit = limit, page = args.page, after = args.cursor, sort = sort, reverse = reverse))
+		else:
+			results = ((cursor, database.File(db, result['hash'], result)) for cursor, result in db.search(query, limit = limit, page = args.page, after = args.cursor, sort = sort, reverse = reverse, fields = ['hash'], cursors = True))
+
+		shown = 0
+		cursor = None
+
+		for cursor, result in results:
+			show_file(db, result, args)
+			shown += 1
+
+		# A full page may have more after it, which can be shown by continuing from its last result.
+		if limit and shown == limit: print('next page: --cursor {}'.format(cursor), file = sys.stderr)
+	except common.FieldDoesNotExistError as e:
+		error('field `{}` does not exist or is not used by any files', e.args[0])
+		return 1
+	except common.InvalidCursorError as e:
+		error('cursor `{}` is invalid, or the database has changed since; search again without it', e.args[0])
+		return 1
 
 ### `set`
 @auto_checkpoint
@@ -212,13 +366,20 @@ def command_set(db, args):
 
 ### `show`
 def command_show(db, args):
-	for hash in args.hash:
-		try:
-			f = db.get(hash)
-			show_file(db, f, args)
+	for hash, f in zip(args.hash, db.get_many(args.hash, return_errors = True)):
+		if isinstance(f, common.AmbiguousHashError): error('{}: ambiguous hash', hash)
+		elif isinstance(f, common.FileDoesNotExistError): error('{}: does not exist', hash)
+		else: show_file(db, f, args)
+
+### `stats`
+def command_stats(db, args):
+	stats = db.stats()
 
-		except common.AmbiguousHashError: error('{}: ambiguous hash', hash)
-		except common.FileDoesNotExistError: error('{}: does not exist', hash)
+	print('files: {}'.format(stats['files']))
+	print('hash index: {} bytes'.format(stats['hash-index-size']))
+	print('filter: {} bytes, room for {} files, {} deleted files'.format(stats['filter-size'], stats['filter-capacity'], stats['filter-deleted']))
+	print('filter fill: {:.1%}, estimated false-positive rate: {:.2%}'.format(stats['filter-fill'], stats['filter-false-positive-rate']))
+	if stats['duplicate-index-built'] is False: print('duplicate index: missing older files (see `qualia maintenance rebuild-duplicates`)')
 
 ### `set`
 @auto_checkpoint
@@ -246,6 +407,7 @@ def command_undo(db, args):
 
 		return 0
 	except common.CheckpointDoesNotExistError: error('checkpoint {}: does not exist', args.checkpoint)
+	except common.CheckpointCompactedError as e: error('checkpoint {}: journal has been compacted past it', e.args[0])
 	except common.UndoFailedError as e: error('could not undo "{}" transaction (no changes done)', e.args[0]['op'])
 
 	return 1
@@ -269,6 +431,15 @@ def _mapping_argument_type(val):
 
 	return tuple(parts)
 
+# Parses a sort specification of the form `FIELD[:asc|:desc]`, returning `(field, reverse)`.
+def _sort_argument_type(value):
+	field, _, order = value.partition(':')
+
+	if not field or order not in ('', 'asc', 'desc'):
+		raise argparse.ArgumentTypeError('should be of format FIELD[:asc|:desc]')
+
+	return field, order == 'desc'
+
 ## Main
 def main():
 	# Read in terminal size, and store it back into the environment. This might make argparse happy
@@ -308,6 +479,16 @@ def main():
 		aliases = ['take'],
 		help = 'add an external file to the DB (use \'take\' to move instead of copying)',
 	)
+	p.add_argument('-j', '--jobs',
+		help = 'Number of files to hash, copy and import metadata from in parallel',
+		type = int,
+		default = 1,
+	)
+	p.add_argument('--link',
+		help = 'How to copy files into the DB: \'reflink\' (copy-on-write clone), \'hardlink\' (only for files that will never change; also makes them read-only), \'copy\', or \'auto\' (reflink or in-kernel copy if possible; default)',
+		choices = database.LINK_MODES,
+		default = 'auto',
+	)
 	p.add_argument('--restore',
 		action = 'store_true',
 		help = 'Restore previous metadata for this file',
@@ -319,6 +500,15 @@ def main():
 		type = argparse.FileType('rb'),
 	)
 
+	p = subparsers.add_parser(
+		'count',
+		help = 'Count files matching a search',
+	)
+	p.add_argument('query',
+		metavar = 'QUERY',
+		nargs = '+'
+	)
+
 	p = subparsers.add_parser(
 		'delete',
 		aliases = ['rm'],
@@ -425,6 +615,25 @@ def main():
 		metavar = 'PREFIX',
 	)
 
+	p = subparsers.add_parser(
+		'gc',
+		help = 'Remove the contents of deleted files',
+	)
+	p.add_argument('-j', '--jobs',
+		help = 'Number of files to remove in parallel',
+		type = int,
+		default = 1,
+	)
+	p.add_argument('-b', '--batch-size',
+		help = 'Number of files to remove in each batch',
+		type = int,
+		default = 1000,
+	)
+	p.add_argument('-v', '--verbose',
+		action = 'store_true',
+		help = 'Show progress after each batch',
+	)
+
 	p = subparsers.add_parser(
 		'import',
 		help = 'Import a previous export',
@@ -442,10 +651,127 @@ def main():
 		type = _mapping_argument_type,
 	)
 
+	p = subparsers.add_parser(
+		'journal',
+		help = 'Maintain the journal',
+	)
+
+	journal_subparsers = p.add_subparsers(
+		title = 'subcommands',
+		dest = 'subcommand',
+		metavar = '<subcommand>',
+	)
+
+	jp = journal_subparsers.add_parser(
+		'compact',
+		help = 'Keep only the latest change to each field from before a checkpoint (which can then no longer be undone)',
+	)
+	jp.add_argument('--before',
+		help = 'Checkpoint to keep all changes from',
+		metavar = 'CHECKPOINT',
+		type = int,
+		required = True,
+	)
+
 	p = subparsers.add_parser(
 		'log',
 		help = 'Print modifications to the database',
 	)
+	p.add_argument('--since',
+		help = 'Only show this checkpoint and later ones',
+		metavar = 'CHECKPOINT',
+		type = int,
+	)
+	p.add_argument('-n', '--limit',
+		help = 'Only show this many of the most recent checkpoints',
+		type = int,
+	)
+
+	p = subparsers.add_parser(
+		'maintenance',
+		help = 'Maintain the search and duplicate indexes',
+	)
+
+	maintenance_subparsers = p.add_subparsers(
+		title = 'subcommands',
+		dest = 'subcommand',
+		metavar = '<subcommand>',
+	)
+
+	mp = maintenance_subparsers.add_parser(
+		'health',
+		help = 'Show the number of segments, deleted documents and size of each field, and check that journal lookups use indexes',
+	)
+
+	mp = maintenance_subparsers.add_parser(
+		'optimize',
+		help = 'Merge the search index into a single segment',
+	)
+
+	mp = maintenance_subparsers.add_parser(
+		'rebuild-duplicates',
+		help = 'Add files stored before duplicates were detected early to the duplicate index',
+	)
+
+	p = subparsers.add_parser(
+		'migrate-hash',
+		help = 'Rehash all files with a different hash scheme',
+	)
+	p.add_argument('scheme',
+		help = 'New hash scheme',
+		metavar = 'SCHEME',
+		choices = config.HASH_SCHEMES,
+	)
+	p.add_argument('-j', '--jobs',
+		help = 'Number of files to rehash in parallel',
+		type = int,
+		default = 1,
+	)
+
+	p = subparsers.add_parser(
+		'migrate-journal',
+		help = 'Convert old journal entries to the current format (otherwise done a little at each commit)',
+	)
+	p.add_argument('-b', '--batch-size',
+		help = 'Number of entries to convert before reporting progress',
+		type = int,
+		default = 10000,
+	)
+
+	p = subparsers.add_parser(
+		'migrate-layout',
+		help = 'Move all files to a more or less deeply nested directory layout',
+	)
+	p.add_argument('depth',
+		help = 'Number of directory levels',
+		metavar = 'DEPTH',
+		type = int,
+	)
+	p.add_argument('-b', '--batch-size',
+		help = 'Number of files to move before reporting progress',
+		type = int,
+		default = 1000,
+	)
+
+	p = subparsers.add_parser(
+		'repack',
+		help = 'Consolidate pack files, reclaiming space from deleted files',
+	)
+
+	p = subparsers.add_parser(
+		'rebuild-filter',
+		help = 'Rebuild the filter used to quickly check whether files exist',
+	)
+
+	p = subparsers.add_parser(
+		'reindex',
+		help = 'Rebuild the search index from the journal (also applies changes to field types)',
+	)
+	p.add_argument('-j', '--jobs',
+		help = 'Number of processes to index files with',
+		type = int,
+		default = 1,
+	)
 
 	p = subparsers.add_parser(
 		'search',
@@ -468,10 +794,31 @@ def main():
 		const = 'long'
 	)
 	p.add_argument('-n', '--limit',
-		help = 'Number of results to show',
+		help = 'Number of results to show (or 0 for all)',
 		type = int,
 		default = 10
 	)
+	p.add_argument('-p', '--page',
+		help = 'Page of results to show',
+		type = int,
+		default = 1
+	)
+	p.add_argument('--page-size',
+		help = 'Number of results on each page (defaults to the limit)',
+		type = int,
+	)
+	p.add_argument('--cursor',
+		help = 'Continue from the cursor shown after the previous page of results',
+	)
+	p.add_argument('-s', '--sort',
+		help = 'Sort results by the given field rather than relevance, in descending order if followed by `:desc`',
+		metavar = 'FIELD[:desc]',
+		type = _sort_argument_type,
+	)
+	p.add_argument('--facet',
+		help = 'Show how many results have each value of the given field, rather than the results',
+		metavar = 'FIELD',
+	)
 
 	p = subparsers.add_parser(
 		'set',
@@ -512,6 +859,11 @@ def main():
 		const = 'long'
 	)
 
+	p = subparsers.add_parser(
+		'stats',
+		help = 'Show statistics about the database and its indexes',
+	)
+
 	p = subparsers.add_parser(
 		'tag',
 		help = 'Add a given tag to a file',
@@ -551,7 +903,7 @@ def main():
 		error('error in configuration file: {}', ('{}: {}'.format(*e.args)) if e.args[0] else e.args[1])
 		sys.exit(1)
 	except common.FieldConfigChangedError as e:
-		error('Configuration for field `{}` changed or removed after adding it to files; database is read-only', e.args[0])
+		error('Configuration for field `{}` changed or removed after adding it to files; database is read-only until `qualia reindex` is run', e.args[0])
 		db = database.Database(db_path, read_only = True)
 
 	### Running command
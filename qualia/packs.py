@@ -0,0 +1,235 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+# 
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+
+# This is the pack store, which keeps small files together in large pack files instead of giving
+# each one a file of its own. This saves inodes, and a lot of per-file overhead when reading,
+# exporting or backing up a database full of small files.
+#
+# Pack files are simply the contents of each object, one after another. A SQLite index maps each
+# hash to the pack, offset and length of its contents, and reads go through a memory map of the
+# pack. Deleting an object only removes it from the index; the space is reclaimed by `repack`.
+#
+## Imports
+from .lazy_import import lazy_import
+
+lazy_import(globals(), """
+	import mmap
+	import os
+	from os import path
+	import sqlite3
+	import threading
+""")
+
+## Constants
+# New objects are appended to the newest pack until it reaches this size.
+MAX_PACK_SIZE = 256 * 1024 * 1024
+
+## Utility functions
+def _sync_and_close(pack_file):
+	pack_file.flush()
+	os.fsync(pack_file.fileno())
+	pack_file.close()
+
+## Pack store
+class PackStore:
+	def __init__(self, directory, read_only = False):
+		self.directory = directory
+		self.read_only = read_only
+
+		# Objects can be read from several threads at once (for instance, by
+		# `Database.migrate_hash`), so everything here is protected by a lock.
+		self.lock = threading.RLock()
+		self.maps = {}
+		self.current_pack = None
+		self.current_file = None
+
+		index_filename = path.join(directory, 'index')
+
+		# Databases from before packs existed have no index, which is the same as an empty one.
+		if read_only and not path.exists(index_filename):
+			self.db = None
+			return
+
+		os.makedirs(directory, exist_ok = True)
+		self.db = sqlite3.connect(
+			'file:' + index_filename + ('?mode=ro' if read_only else ''),
+			uri = True,
+			check_same_thread = False,
+		)
+
+		if not read_only:
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.upgrade_if_needed()
+
+	# This works just like `Journal.upgrade_if_needed`.
+	def upgrade_if_needed(self):
+		version = self.db.execute('PRAGMA user_version').fetchone()[0]
+
+		updates = [
+			"""
+				CREATE TABLE IF NOT EXISTS objects (
+					hash TEXT PRIMARY KEY,
+					pack INTEGER,
+					offset INTEGER,
+					length INTEGER
+				);
+			""",
+			# The compression used for the object's contents, if any (see
+			# `qualia.database.Database.compress_staged`).
+			"""
+				ALTER TABLE objects ADD COLUMN compression TEXT;
+			""",
+		]
+
+		for version, update in enumerate(updates[version:], version + 1):
+			self.db.executescript(update)
+			self.db.execute("PRAGMA user_version = {}".format(version))
+
+	def _pack_filename(self, pack):
+		return path.join(self.directory, '{:08d}.pack'.format(pack))
+
+	# Returns `(pack, offset, length, compression)` for the given hash, or `None` if it isn't in a
+	# pack.
+	def get(self, hash):
+		if self.db is None: return None
+
+		with self.lock:
+			return self.db.execute('SELECT pack, offset, length, compression FROM objects WHERE hash = ?', (hash,)).fetchone()
+
+	def __contains__(self, hash):
+		return self.get(hash) is not None
+
+	# Returns the contents of the given object as stored (so possibly still compressed), read
+	# through the memory map of its pack.
+	def read(self, hash):
+		location = self.get(hash)
+		if location is None: raise KeyError(hash)
+
+		pack, offset, length, _ = location
+
+		with self.lock:
+			pack_map = self.maps.get(pack)
+
+			# Packs can grow after being mapped, in which case they have to be mapped again.
+			if pack_map is None or len(pack_map) < offset + length:
+				if pack == self.current_pack: self.current_file.flush()
+
+				with open(self._pack_filename(pack), 'rb') as pack_file:
+					pack_map = self.maps[pack] = mmap.mmap(pack_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+			return pack_map[offset:offset + length]
+
+	# Opens the pack that new objects should be appended to, starting a new one if the latest is
+	# full.
+	def _open_current(self, length):
+		if self.current_file and self.current_file.tell() + length <= MAX_PACK_SIZE:
+			return
+
+		if self.current_file:
+			self._close_current()
+			pack = self.current_pack + 1
+		else:
+			pack = self.db.execute('SELECT MAX(pack) FROM objects').fetchone()[0]
+
+			if pack is None:
+				pack = 0
+			elif path.getsize(self._pack_filename(pack)) + length > MAX_PACK_SIZE:
+				pack += 1
+
+		self.current_pack = pack
+		self.current_file = open(self._pack_filename(pack), 'ab')
+
+	def _close_current(self):
+		_sync_and_close(self.current_file)
+		self.current_file = None
+
+	# Appends the contents of a new object to the current pack.
+	def append(self, hash, data, compression = None):
+		with self.lock:
+			self._open_current(len(data))
+
+			offset = self.current_file.tell()
+			self.current_file.write(data)
+			self.db.execute('INSERT OR REPLACE INTO objects(hash, pack, offset, length, compression) VALUES(?, ?, ?, ?, ?)', (hash, self.current_pack, offset, len(data), compression))
+
+	def delete(self, hash):
+		with self.lock:
+			self.db.execute('DELETE FROM objects WHERE hash = ?', (hash,))
+
+	# Rewrites the hashes in `renames` (a mapping of old to new hashes) after a change of hash
+	# scheme. Objects that aren't in a pack are ignored.
+	def rename_files(self, renames):
+		with self.lock:
+			self.db.executemany('UPDATE objects SET hash = ? WHERE hash = ?', ((new, old) for old, new in renames.items()))
+			self.db.commit()
+
+	# Makes sure everything appended so far is on disk before committing the index, so the index
+	# never points past the end of a pack.
+	def commit(self):
+		with self.lock:
+			if self.current_file:
+				self.current_file.flush()
+				os.fsync(self.current_file.fileno())
+
+			self.db.commit()
+
+	# Rewrites all objects that are still in the index into new, full packs (in hash order), then
+	# removes the old packs. This reclaims the space used by deleted objects, and merges any
+	# partially-filled packs. Returns the number of packs before and after.
+	#
+	# Nothing refers to the new packs until the index is switched over in a single transaction, so
+	# an interrupted repack only leaves behind unused packs that the next repack will remove.
+	def repack(self):
+		with self.lock:
+			self.commit()
+			if self.current_file: self._close_current()
+
+			old_packs = sorted(
+				int(filename[:-len('.pack')])
+				for filename in os.listdir(self.directory)
+				if filename.endswith('.pack')
+			)
+			if not old_packs: return 0, 0
+
+			pack = old_packs[-1]
+			pack_file = None
+			locations = []
+
+			for hash, in self.db.execute('SELECT hash FROM objects ORDER BY hash').fetchall():
+				data = self.read(hash)
+
+				if pack_file is None or pack_file.tell() + len(data) > MAX_PACK_SIZE:
+					if pack_file: _sync_and_close(pack_file)
+					pack += 1
+					pack_file = open(self._pack_filename(pack), 'wb')
+
+				locations.append((pack, pack_file.tell(), hash))
+				pack_file.write(data)
+
+			if pack_file: _sync_and_close(pack_file)
+
+			with self.db:
+				self.db.executemany('UPDATE objects SET pack = ?, offset = ? WHERE hash = ?', locations)
+
+			for old_pack in old_packs:
+				old_map = self.maps.pop(old_pack, None)
+				if old_map is not None: old_map.close()
+
+				os.unlink(self._pack_filename(old_pack))
+
+			return len(old_packs), pack - old_packs[-1]
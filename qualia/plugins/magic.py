@@ -1,20 +1,34 @@
 from qualia import config
 
+import threading
+
 def register(**kwargs):
 	config.DB_STATE_BASE['fields']['magic.mime-type'] = config.DerivedDictItem(config.FIELD_ITEM_BASE,
 		'type', config.FixedItem('exact-text'),
 		'aliases', ['mime', 'dc.format'],
 	)
 
-magic_db = None
+# libmagic handles cannot be shared between threads, so each thread running this importer (see
+# `qualia.conversion.stage_files`) gets its own, one for each set of flags it uses.
+_local = threading.local()
 
-def auto_add_magic(f, original_filename):
-	global magic_db
+# Returns this thread's libmagic handle for the given flags, which are names of `magic` constants.
+def _magic_db(*flags):
+	magic_dbs = _local.__dict__.setdefault('magic_dbs', {})
 
-	if magic_db is None:
+	if flags not in magic_dbs:
 		import magic
 
-		magic_db = magic.open(magic.SYMLINK | magic.COMPRESS | magic.MIME_TYPE)
+		magic_db = magic_dbs[flags] = magic.open(sum(getattr(magic, flag) for flag in flags))
 		magic_db.load()
 
-	f.set_metadata('magic.mime-type', magic_db.file(original_filename), 'auto')
+	return magic_dbs[flags]
+
+# Returns the MIME type of the given file itself, as used by `qualia.conversion.detect_mime_type`.
+# Unlike the `magic.mime-type` field, this doesn't look inside compressed files, so (for instance) a
+# gzipped file is `application/gzip` rather than whatever it contains.
+def detect_mime_type(filename):
+	return _magic_db('SYMLINK', 'MIME_TYPE').file(filename)
+
+def auto_add_magic(f, original_filename):
+	f.set_metadata('magic.mime-type', _magic_db('SYMLINK', 'COMPRESS', 'MIME_TYPE').file(original_filename), 'auto')
@@ -20,23 +20,76 @@ from .lazy_import import lazy_import
 from . import config, common
 
 lazy_import(globals(), """
+	import collections
+	import contextlib
 	import copy
+	import datetime
+	import glob
+	import itertools
+	import os
+	from os import path
+	import pickle
+	import shutil
 	import sys
-	from whoosh import analysis, fields, index, qparser, query, writing
+	from whoosh import analysis, collectors, fields, index, qparser, query, reading, sorting, writing
 """)
 
+## Constants
+# The number of parsed queries kept by `SearchDatabase._parse_query`.
+QUERY_CACHE_SIZE = 512
+
+# `SearchDatabase.rebuild` reports its progress after every this many documents.
+REBUILD_PROGRESS_INTERVAL = 1000
+
 ## Utility functions
+# Returns the Whoosh merge policies that can be set with the `search-merge-policy` option, which
+# decide which segments are merged together at each commit. (This is a function to avoid importing
+# whoosh early.)
+def _merge_policies():
+	return {
+		# Only merge small segments (Whoosh's default).
+		'small': writing.MERGE_SMALL,
+		# Never merge segments; see `SearchDatabase.optimize`.
+		'none': writing.NO_MERGE,
+		# Merge everything into one segment at every commit.
+		'full': writing.OPTIMIZE,
+	}
+
 # Creates the underlying Whoosh field given the configuration for the given field.
+#
+# Fields that are likely to be sorted or faceted on also get a column, which lets Whoosh do so
+# without reading the stored documents.
 def _create_field_type(field_config):
 	return dict(
-		datetime = fields.DATETIME(stored = True),
-		exact_text = fields.ID(stored = True),
-		id = fields.ID(unique = True, stored = True),
-		keyword = fields.KEYWORD(stored = True),
-		number = fields.NUMERIC(stored = True),
+		datetime = fields.DATETIME(stored = True, sortable = True),
+		exact_text = fields.ID(stored = True, sortable = True),
+		id = fields.ID(unique = True, stored = True, sortable = True),
+		keyword = fields.KEYWORD(stored = True, sortable = True),
+		number = fields.NUMERIC(stored = True, sortable = True),
 		text = fields.TEXT(analyzer = analysis.StemmingAnalyzer(), stored = True),
 	)[field_config['type'].replace('-', '_')]
 
+# Checks whether two Whoosh field types are the same, apart from their columns. This is what
+# Whoosh's own comparison does, except that columns can't be compared once they're loaded from disk,
+# and fields added before columns were used don't have them (but can still be sorted on, just more
+# slowly).
+def _same_field_type(a, b):
+	return type(a) is type(b) and all(getattr(a, attr) == getattr(b, attr) for attr in ('format', 'scorable', 'stored', 'unique'))
+
+# Converts a value from the journal into what the given Whoosh field type expects, in case the type
+# of its field has been changed since it was set. Returns `None` if it can't be converted.
+def _coerce_value(field_type, value):
+	try:
+		# (`DATETIME` is a subclass of `NUMERIC`, so it has to be checked first.)
+		if isinstance(field_type, fields.DATETIME):
+			return value if isinstance(value, datetime.datetime) else None
+		elif isinstance(field_type, fields.NUMERIC):
+			return value if isinstance(value, (int, float)) else float(value)
+		else:
+			return value if isinstance(value, str) else str(value)
+	except (TypeError, ValueError):
+		return None
+
 # This plugin for the Whoosh query parser allows field aliases to be correctly interpreted.
 # It is defined in a roundabout way to avoid importing whoosh early.
 def _FieldAliasPlugin(map):
@@ -93,6 +146,112 @@ def _FieldAliasPlugin(map):
 
 	return _FieldAliasPlugin(map)
 
+# This is the writer used for all changes to the search index. Like Whoosh's `BufferedWriter`, it
+# keeps new documents in memory (where they can be searched) until they're committed, but it also
+# keeps a rough count of how large they are, so `SearchDatabase` can commit them early if they get
+# too big (see `SearchDatabase._spill_if_needed`).
+#
+# `BufferedWriter` also copies the documents it has buffered into the index with `add_reader`, which
+# loses their column values (as its in-memory segments don't expose them). This writer adds them to
+# the index as normal documents instead, so their columns are filled in from their stored fields
+# (which, in Qualia, are all of them).
+#
+# Commits never merge any existing segments unless given a different `mergetype`, so that a
+# checkpoint can be rolled back (see `SearchDatabase._begin_checkpoint`).
+#
+# Like the plugin above, this is defined in a roundabout way to avoid importing whoosh early.
+def _BufferedWriter(*args, **kwargs):
+	class _BufferedWriter(writing.BufferedWriter):
+		buffered_size = 0
+
+		def update_document(self, **fields):
+			super().update_document(**fields)
+			self.buffered_size += sum(len(str(value)) for value in fields.values())
+
+		def commit(self, restart = True, mergetype = None):
+			with self.lock:
+				ramreader = self._get_ram_reader()
+				self._make_ram_index()
+
+			if self.bufferedcount:
+				for _, stored in ramreader.iter_docs():
+					self.writer.add_document(**stored)
+
+			self.writer.commit(mergetype = mergetype or writing.NO_MERGE)
+			self.bufferedcount = 0
+			self.buffered_size = 0
+
+			if restart:
+				self.writer = self.index.writer(**self.writerargs)
+
+	return _BufferedWriter(*args, **kwargs)
+
+# This collects a page of results that continues from a cursor (see `SearchDatabase.search`): the
+# first `limit` hits (or all of them, if `limit` is `None`) whose `(key, docnum)` comes after
+# `after`, in the order given by the sort keys of `child`. Hits before the cursor are skipped without
+# being kept, and no more than twice `limit` are held at once, so a page costs about as much memory
+# wherever it is in the results.
+#
+# Like the writer above, this is defined in a roundabout way to avoid importing whoosh early.
+def _PageCollector(*args, **kwargs):
+	class _PageCollector(collectors.WrappingCollector):
+		def __init__(self, child, after, limit):
+			super().__init__(child)
+			self.after = after
+			self.limit = limit
+			self.hits = []
+
+		def collect(self, sub_docnum):
+			hit = (self.child.sort_key(sub_docnum), self.offset + sub_docnum)
+			if hit <= self.after: return
+
+			self.hits.append(hit)
+
+			if self.limit is not None and len(self.hits) >= 2 * self.limit:
+				self.hits.sort()
+				del self.hits[self.limit:]
+
+		# Returns the hits on the page, in order.
+		def page(self):
+			self.hits.sort()
+			return self.hits[:self.limit]
+
+	return _PageCollector(*args, **kwargs)
+
+# Returns the number of bytes taken up by a term and its postings in a segment. Postings are either
+# in a block of their own, or (when there are only a few) pickled into the term dictionary.
+def _term_size(text, term_info):
+	if term_info.is_inlined(): return len(text) + len(pickle.dumps(term_info.inlined_postings(), 2))
+
+	# (Whoosh 2.7 reads the length back as a one-element tuple.)
+	length = term_info.extent()[1]
+	if isinstance(length, tuple): length = length[0]
+
+	return len(text) + length
+
+# A cursor (see `SearchDatabase.search`) is made up of the generation of the index, the order of the
+# results, the document number of a result and its sort key, separated by colons. Sort keys are
+# integers, floats (written exactly with `float.hex`) or bytes (in hex), each marked with a letter.
+def _encode_cursor(generation, order, key, docnum):
+	if isinstance(key, int):
+		key = 'i{:d}'.format(key)
+	elif isinstance(key, float):
+		key = 'f' + key.hex()
+	else:
+		key = 'b' + bytes(key).hex()
+
+	return '{}:{}:{}:{}'.format(generation, order, docnum, key)
+
+# Returns the generation, order, sort key and document number in the given cursor.
+def _decode_cursor(cursor):
+	try:
+		generation, order, docnum, key = cursor.split(':', 3)
+		key = {'i': int, 'f': float.fromhex, 'b': bytes.fromhex}[key[0]](key[1:])
+
+		return int(generation), order, key, int(docnum)
+	except (IndexError, KeyError, ValueError):
+		raise common.InvalidCursorError(cursor)
+
 ## Search database
 # This DB serves two purposes in Qualia: it keeps an index of all the metadata contents to allow
 # for quick searching, and serves as an easy way to get the latest metadata for a given file.
@@ -104,16 +263,21 @@ class SearchDatabase:
 		# First, load all the actually configured fields.
 		self.configured_fields = {field: _create_field_type(value) for field, value in self.db.fields.items()}
 
+		self.base_path = base_path
+		if not read_only: self._finish_rebuild()
+
 		# Then, depending on whether the database has been previously set up, we either:
 		if index.exists_in(base_path):
 			# a) check to make sure that any previously configured fields have not been changed.
 			self.index = index.open_dir(base_path)
+			if not read_only: self._recover()
 
 			for name, field in self.index.schema.items():
-				if (name not in self.configured_fields or field != self.configured_fields[name]) and not read_only:
+				if (name not in self.configured_fields or not _same_field_type(field, self.configured_fields[name])) and not read_only:
 					raise common.FieldConfigChangedError(name)
 		else:
 			if read_only: raise RuntimeError('Search index does not exist, cannot create in read_only mode')
+			os.makedirs(base_path, exist_ok = True)
 			# or b) create a schema containing only the required fields `'hash'` and `'comments'`.
 			schema = fields.Schema()
 			schema.add('hash', self.configured_fields['hash'])
@@ -122,6 +286,26 @@ class SearchDatabase:
 			self.index = index.create_in(base_path, schema)
 
 		self._open_writer = None
+		self._checkpoint_started = False
+		# This is set by anything that changes the index, so that `commit` doesn't write out a new
+		# generation when nothing has changed.
+		self._has_changes = False
+
+		# The searcher is kept open between calls (see `_searcher`), and these count how often that
+		# saved opening a new one (for `python -m qualia.benchmark search`).
+		self._session = None
+		self._session_stale = False
+		self.searcher_stats = {'opened': 0, 'reused': 0}
+		# The number of generators still reading from each searcher (see `_searching`).
+		self._searcher_users = {}
+
+		# The query parser is only rebuilt when the schema might have changed, and recently parsed
+		# queries are kept in an LRU cache (see `_parse_query`). Like `searcher_stats`, the counts of
+		# hits and misses are for `python -m qualia.benchmark search`.
+		self._parser = None
+		self._parser_generation = None
+		self._query_cache = collections.OrderedDict()
+		self.query_cache_stats = {'hits': 0, 'misses': 0}
 
 		# Finally, we create the alias map for the parser plugin above.
 		self.field_alias_map = {}
@@ -134,16 +318,153 @@ class SearchDatabase:
 		if self.read_only: raise common.DatabaseReadOnlyError()
 
 		if not self._open_writer: 
-			# This is a kind of terrible hack to give us roughly-atomic checkpoints.
-			self._open_writer = writing.BufferedWriter(self.index, limit = sys.maxsize, period = None)
+			# The buffered writer's own limits are turned off, as `_spill_if_needed` decides when
+			# to commit.
+			self._open_writer = _BufferedWriter(self.index, limit = sys.maxsize, period = None)
+
+		if not self._checkpoint_started: self._begin_checkpoint()
+		self._has_changes = True
 
 		return self._open_writer
 
+	### Checkpoints
+	# Changes to the index should only become permanent once the checkpoint they're part of is
+	# committed. Most of the time, they're simply held in memory by the writer until then, but large
+	# imports may have to be written out early to keep memory use bounded.
+	#
+	# To allow this, the table of contents of the index as of the last checkpoint is saved before
+	# any changes are made, and the writer never merges existing segments until the checkpoint is
+	# finished (so the old table of contents stays valid). If the process dies before then, the
+	# next `SearchDatabase` to open the index puts the old table of contents back.
+	#
+	# The saved copy is kept in `checkpoint-<generation>.toc`.
+	def _saved_checkpoint(self):
+		for filename in glob.glob(path.join(self.base_path, 'checkpoint-*.toc')):
+			return filename, int(path.basename(filename)[len('checkpoint-'):-len('.toc')])
+
+		return None
+
+	def _begin_checkpoint(self):
+		generation = self.index.latest_generation()
+		toc_filename = path.join(self.base_path, index.TOC._filename(self.index.indexname, generation))
+		checkpoint_filename = path.join(self.base_path, 'checkpoint-{}.toc'.format(generation))
+
+		with open(toc_filename, 'rb') as toc_file, open(checkpoint_filename + '.new', 'wb') as checkpoint_file:
+			shutil.copyfileobj(toc_file, checkpoint_file)
+			checkpoint_file.flush()
+			os.fsync(checkpoint_file.fileno())
+
+		os.replace(checkpoint_filename + '.new', checkpoint_filename)
+		self._checkpoint_started = True
+
+	# Commits the pending documents early if they've reached the `search-writer-memory` budget.
+	def _spill_if_needed(self):
+		if self._open_writer.buffered_size >= config.conf.get('search-writer-memory', 256) * 1024 * 1024:
+			self._open_writer.commit()
+			self._session_stale = True
+
+	# Commits the pending documents early if there are any, as Whoosh can't sort or group the ones
+	# still held in memory by the writer (it has no columns for them). Like a spill, this stays part
+	# of the current checkpoint.
+	def _flush_for_sorting(self):
+		if self._open_writer and self._open_writer.bufferedcount:
+			self._open_writer.commit()
+			self._session_stale = True
+
+	# Called once the checkpoint that the changes made so far are part of has been committed (after
+	# `commit` and the journal's commit), after which they can no longer be rolled back. Any
+	# segments that need it are then merged according to the `search-merge-policy` option.
+	def finish_checkpoint(self):
+		if not self._checkpoint_started: return
+
+		os.unlink(self._saved_checkpoint()[0])
+		self._checkpoint_started = False
+
+		merge_policy = config.conf.get('search-merge-policy', 'small')
+
+		if self._open_writer and merge_policy != 'none':
+			self._open_writer.commit(mergetype = _merge_policies()[merge_policy])
+			self._session_stale = True
+
+	# Puts back the table of contents saved by `_begin_checkpoint`, if the last process to make
+	# changes to the index died before finishing its checkpoint. If the index is locked, another
+	# process is still making changes, and this does nothing.
+	#
+	# If the process died after the journal was committed (which records the generation of the index
+	# it goes with) but before the saved copy was removed, the changes are kept.
+	def _recover(self):
+		checkpoint = self._saved_checkpoint()
+		if checkpoint is None: return
+
+		lock = self.index.lock('WRITELOCK')
+		if not lock.acquire(): return
+
+		try:
+			checkpoint_filename, checkpoint_generation = checkpoint
+			storage, indexname = self.index.storage, self.index.indexname
+			generation = self.index.latest_generation()
+
+			if checkpoint_generation != generation and self.db.journal.search_generation() != generation:
+				# Whoosh can only read the table of contents under its original name, which has
+				# been cleaned up by now; it's then written back out as the newest generation.
+				toc_filename = path.join(self.base_path, index.TOC._filename(indexname, checkpoint_generation))
+				shutil.copyfile(checkpoint_filename, toc_filename)
+
+				toc = index.TOC.read(storage, indexname, checkpoint_generation)
+				toc.generation = generation + 1
+				toc.write(storage, indexname)
+				index.clean_files(storage, indexname, toc.generation, toc.segments)
+
+			os.unlink(checkpoint_filename)
+		finally:
+			lock.release()
+
+	# Returns a searcher for the current contents of the index. The same searcher is reused until
+	# something is written through this object or the index on disk moves to a new generation.
+	#
+	# The searcher that is replaced is closed, unless a generator is still reading from it (see
+	# `_searching`), in which case it's closed once that's done.
 	def _searcher(self):
+		if self._session is not None and not self._session_stale and (self._open_writer or self._session.up_to_date()):
+			self.searcher_stats['reused'] += 1
+			return self._session
+
+		previous = self._session
+
 		if self._open_writer: 
-			return self._open_writer.searcher()
+			self._session = self._open_writer.searcher()
 		else:
-			return self.index.searcher()
+			self._session = self.index.searcher()
+
+		if previous is not None and previous not in self._searcher_users: previous.close()
+
+		self._session_stale = False
+		self.searcher_stats['opened'] += 1
+
+		return self._session
+
+	# Gives a searcher (from `_searcher`) to code that keeps reading from it after returning, like a
+	# generator, so that it isn't closed in the meantime.
+	@contextlib.contextmanager
+	def _searching(self):
+		searcher = self._searcher()
+		self._searcher_users[searcher] = self._searcher_users.get(searcher, 0) + 1
+
+		try:
+			yield searcher
+		finally:
+			self._searcher_users[searcher] -= 1
+
+			if not self._searcher_users[searcher]:
+				del self._searcher_users[searcher]
+				if searcher is not self._session: searcher.close()
+
+	# Closes the current searcher (or, if it's still being read from, lets it be closed once it's
+	# done). Later calls will simply open a new one.
+	def close(self):
+		if self._session is not None:
+			if self._session not in self._searcher_users: self._session.close()
+			self._session = None
 
 	def _schema(self):
 		if self._open_writer: 
@@ -151,41 +472,198 @@ class SearchDatabase:
 		else:
 			return self.index.schema
 
-	# Flushes all pending index changes.
+	# Returns the generation of the index on disk, which goes up with every commit.
+	def generation(self):
+		return self.index.latest_generation()
+
+	# Flushes all pending index changes, if there are any.
 	def commit(self):
-		if self._open_writer: self._open_writer.commit()
+		if self._open_writer and self._has_changes:
+			self._open_writer.commit()
+			self._session_stale = True
+
+		self._has_changes = False
+
+	# Merges all of the segments in the index into one, leaving out any deleted documents. This
+	# yields `(merged, total)` as each segment is read, and any pending changes are committed first.
+	def optimize(self):
+		if self.read_only: raise common.DatabaseReadOnlyError()
+
+		# The buffered writer holds the index's lock, so it has to be closed before we can write.
+		if self._open_writer:
+			self._open_writer.close()
+			self._open_writer = None
+			self._session_stale = True
+
+		writer = self.index.writer()
+		segments = list(writer.segments)
+
+		try:
+			for merged, segment in enumerate(segments, 1):
+				reader = reading.SegmentReader(writer.storage, writer.schema, segment)
+				writer.add_reader(reader)
+				reader.close()
+
+				yield merged, len(segments)
+		except:
+			writer.cancel()
+			raise
+
+		# All the old segments have been copied into the new one, so none of them are kept.
+		writer.commit(mergetype = writing.CLEAR)
+
+	### Rebuilding
+	# Replaces the index with a new one made from `documents` (an iterable of `total` metadata
+	# `dict`s), with the given fields. This yields `(indexed, total)` as it goes. With more than one
+	# job, the documents are indexed by that many processes at once, each writing its own segments.
+	#
+	# The new index is built in `<base_path>.new` and only moved into place once it's complete, so
+	# the old one can still be searched until then (and is locked so nothing else can change it).
+	# As the old index is never written to, this also works in read-only mode.
+	def rebuild(self, documents, field_names, total, jobs = 1):
+		# The buffered writer holds the index's lock, so it has to be closed before we can take it.
+		if self._open_writer:
+			self._open_writer.close()
+			self._open_writer = None
+			self._checkpoint_started = False
+
+		lock = self.index.lock('WRITELOCK')
+		if not lock.acquire(): raise index.LockError()
+
+		new_path = self.base_path + '.new'
+
+		try:
+			shutil.rmtree(new_path, ignore_errors = True)
+			os.mkdir(new_path)
+
+			schema = fields.Schema()
+			for field in sorted(set(field_names) | {'hash', 'comments'}):
+				if field in self.configured_fields: schema.add(field, self.configured_fields[field])
+
+			new_index = index.create_in(new_path, schema)
+
+			# The new index continues from the old one's generation, so anything that records which
+			# generation it matches (like the hash index) can tell that it's changed.
+			toc = index.TOC(schema, [], self.index.latest_generation())
+			toc.write(new_index.storage, new_index.indexname)
+			index.clean_files(new_index.storage, new_index.indexname, toc.generation, [])
+
+			memory = config.conf.get('search-writer-memory', 256)
+			writer = new_index.writer(procs = jobs, multisegment = jobs > 1, limitmb = max(memory // jobs, 1))
+			indexed = 0
+
+			try:
+				for metadata in documents:
+					document = {}
+
+					for field, value in metadata.items():
+						if field not in schema: continue
+
+						value = _coerce_value(schema[field], value)
+						if value is not None: document[field] = value
+
+					writer.add_document(**document)
+					indexed += 1
+
+					if indexed % REBUILD_PROGRESS_INTERVAL == 0: yield indexed, total
+			except:
+				writer.cancel()
+				raise
+
+			writer.commit()
+			if indexed % REBUILD_PROGRESS_INTERVAL: yield indexed, total
+		except:
+			shutil.rmtree(new_path, ignore_errors = True)
+			lock.release()
+			raise
+
+		self.close()
+
+		old_path = self.base_path + '.old'
+		if path.exists(self.base_path): os.rename(self.base_path, old_path)
+		os.rename(new_path, self.base_path)
+
+		lock.release()
+		shutil.rmtree(old_path, ignore_errors = True)
+
+		self.index = index.open_dir(self.base_path)
+		self._invalidate_parser()
+		self._parser_generation = None
+
+	# Finishes moving a new index into place, if a `rebuild` was interrupted just after it moved
+	# the old one out of the way. (If it was interrupted any earlier, the new index may not be
+	# complete, and is simply thrown away by the next `rebuild`.)
+	def _finish_rebuild(self):
+		new_path, old_path = self.base_path + '.new', self.base_path + '.old'
+
+		if not path.exists(self.base_path) and path.exists(old_path) and path.exists(new_path):
+			os.rename(new_path, self.base_path)
+
+		if path.exists(self.base_path) and path.exists(old_path):
+			shutil.rmtree(old_path)
+
+	# Returns a `dict` describing the state of the index on disk: the number of documents (and
+	# deleted documents) in each segment, the total size, and the number of distinct terms and
+	# postings for each field.
+	#
+	# The size of each field is that of its terms and postings in every segment (see `_term_size`).
+	# Stored values and columns aren't kept by field, so they're only counted in the total.
+	def health(self):
+		with self.index.reader() as reader:
+			field_stats = {field: {'terms': 0, 'postings': 0, 'size': 0} for field in reader.schema.names()}
+			segments = []
+
+			for segment_reader, _ in reader.leaf_readers():
+				segments.append({
+					'documents': segment_reader.doc_count_all(),
+					'deleted': segment_reader.doc_count_all() - segment_reader.doc_count(),
+				})
+
+				for (field, text), term_info in segment_reader:
+					field_stats[field]['size'] += _term_size(text, term_info)
+
+			for (field, _), term_info in reader:
+				field_stats[field]['terms'] += 1
+				field_stats[field]['postings'] += term_info.doc_frequency()
+
+		storage = self.index.storage
+
+		return {
+			'segments': segments,
+			'size': sum(storage.file_length(name) for name in storage.list()),
+			'fields': field_stats,
+		}
 
 	# Adds a new file to the database.
 	def add(self, hash):
 		writer = self._writer()
+		self._session_stale = True
 		# We use update_document, rather than add_document, so that this function can be mostly
 		# idempotent.
 		writer.update_document(hash = hash)
+		self._spill_if_needed()
 
 	# Returns all files in the database.
 	def all(self):
-		with self._searcher() as searcher:
+		with self._searching() as searcher:
 			for _, metadata in searcher.iter_docs():
 				yield metadata
 
 	# Gets a `dict` of all the metadata for the given file.
 	def get(self, hash):
-		with self._searcher() as searcher:
-			return searcher.document(hash = hash)
+		return self._searcher().document(hash = hash)
 
-	# Find whether the given document exists.
-	def exists(self, hash):
-		with self._searcher() as searcher:
-			return bool(searcher.document_number(hash = hash))
+	# Gets the metadata for several files at once, returning a `dict` mapping each of the given
+	# hashes that exists to its metadata. This runs a single query for all of them, rather than
+	# one for each.
+	def get_many(self, hashes):
+		searcher = self._searcher()
+		q = query.Or([query.Term('hash', hash) for hash in hashes])
 
-	# Find all hashes starting with the given prefix.
-	def find_hashes(self, prefix):
-		with self._searcher() as searcher:
-			for docnum in searcher.docs_for_query(query.Prefix('hash', prefix)):
-				yield searcher.stored_fields(docnum)['hash']
+		return {metadata['hash']: metadata for metadata in (searcher.stored_fields(docnum) for docnum in searcher.docs_for_query(q))}
 
-	# Internal utility method to parse the given search query.
-	def _parse_query(self, query):
+	# Internal utility method to create the query parser for the current schema.
+	def _create_parser(self):
 		# We default to searching the comments field if no explicit field is given.
 		parser = qparser.QueryParser('comments', self._schema())
 		# Add support for using >, <, <=, etc. in numeric/timestamp fields.
@@ -197,27 +675,167 @@ class SearchDatabase:
 		# And finally add our field alias plugin.
 		parser.add_plugin(_FieldAliasPlugin(self.field_alias_map))
 
-		return parser.parse(query)
+		return parser
 
-	# Runs a search and returns the result.
-	def search(self, query_text, limit):
-		q = self._parse_query(query_text)
+	# Throws away the query parser and any queries it parsed, as the schema has changed.
+	def _invalidate_parser(self):
+		self._parser = None
+		self._query_cache.clear()
 
-		# As this `with` holds the search index open, this iterator should be read to completion.
-		with self._searcher() as searcher:
-			results = searcher.search(q, limit = limit)
-
-			for result in results:
-				yield dict(result)
+	# Internal utility method to parse the given search query.
+	#
+	# The schema can only change when fields are added by `save` (which invalidates the parser
+	# itself) or when another process commits, which changes the generation of the index.
+	def _parse_query(self, query):
+		if not self._open_writer:
+			generation = self.index.latest_generation()
+
+			if generation != self._parser_generation:
+				self._invalidate_parser()
+				self._parser_generation = generation
+
+		if query in self._query_cache:
+			self.query_cache_stats['hits'] += 1
+			self._query_cache.move_to_end(query)
+
+			return self._query_cache[query]
+
+		self.query_cache_stats['misses'] += 1
+
+		if self._parser is None: self._parser = self._create_parser()
+		q = self._query_cache[query] = self._parser.parse(query)
+
+		if len(self._query_cache) > QUERY_CACHE_SIZE: self._query_cache.popitem(last = False)
+
+		return q
+
+	# Internal utility method to find the actual name of a field that may have been given by an
+	# alias, raising an error if it isn't in the index.
+	def _resolve_field(self, field):
+		field = self.field_alias_map.get(field, field)
+
+		if field not in self._schema().names():
+			raise common.FieldDoesNotExistError(field)
+
+		return field
+
+	# Runs a search and returns the result, skipping the first `offset` results. Results are sorted
+	# by relevance, unless `sort` gives a field to sort by instead (in which case they aren't
+	# scored). If `fields` is given, only those fields of each result are returned.
+	#
+	# If `cursors` is set, `(cursor, result)` pairs are returned instead. A cursor can be given as
+	# `after` to continue the same search just after that result. It holds the result's sort key
+	# (its score, or the value of the sorted field) and document number rather than its position, so
+	# the search picks up where it left off by comparing those.
+	#
+	# Document numbers and scores change whenever the index does, so a cursor only works with the
+	# generation of the index it came from; otherwise (or if there are uncommitted changes, which
+	# could have moved things around) this raises `common.InvalidCursorError`.
+	#
+	# Asking for just `['hash']` reads the hashes from their column where the index has one (see
+	# `_hash_column`), without loading the rest of each file's metadata. Any other list of fields
+	# still loads all of it, and only trims what is returned.
+	#
+	# If `limit` is `None` and no sort is given, every match is returned in index order. The
+	# matches are read one at a time, without scoring them, so this takes the same amount of memory
+	# no matter how many there are. These have no order to continue from, so they don't have
+	# cursors (and their cursor is `None`).
+	def search(self, query_text, limit, offset = 0, sort = None, reverse = False, fields = None, after = None, cursors = False):
+		q = self._parse_query(query_text)
+		if sort is not None: self._flush_for_sorting()
+
+		generation = self.generation()
+		order = '' if sort is None else ('-' if reverse else '+') + self._resolve_field(sort)
+
+		if after is not None:
+			after_generation, after_order, after_key, after_docnum = _decode_cursor(after)
+
+			if limit is None and sort is None: raise ValueError('unordered results have no cursors')
+			if after_generation != generation or after_order != order or self._has_changes: raise common.InvalidCursorError(after)
+
+		with self._searching() as searcher:
+			# Each hit is `(key, docnum)`, in the order they're returned; the score of each hit is
+			# negated to make this so for results sorted by relevance.
+			if limit is None and sort is None:
+				hits = ((None, docnum) for docnum in searcher.docs_for_query(q))
+			else:
+				top = None if limit is None else offset + limit
+
+				if sort is not None:
+					facet = sorting.FieldFacet(self._resolve_field(sort), reverse = reverse)
+
+				if after is not None:
+					# The sort keys of these collectors are the same as the keys below.
+					if sort is not None:
+						child = collectors.SortingCollector(facet)
+					else:
+						child = collectors.UnlimitedCollector()
+
+					collector = _PageCollector(child, (after_key, after_docnum), top)
+					searcher.search_with_collector(q, collector)
+					hits = collector.page()
+				elif sort is not None:
+					hits = ((hit.score, hit.docnum) for hit in searcher.search(q, limit = top, sortedby = facet, scored = False))
+				else:
+					hits = ((-hit.score, hit.docnum) for hit in searcher.search(q, limit = top))
+
+			hashes = self._hash_column(searcher) if fields == ['hash'] else None
+
+			for key, docnum in itertools.islice(hits, offset, None if limit is None else offset + limit):
+				if hashes is not None:
+					result = {'hash': hashes[docnum]}
+				else:
+					result = searcher.stored_fields(docnum)
+					if fields is not None: result = {field: result[field] for field in fields if field in result}
+
+				if cursors:
+					yield (None if key is None else _encode_cursor(generation, order, key, docnum)), result
+				else:
+					yield result
+
+	# Returns a column reader for the hashes of the documents in the given searcher, or `None` if
+	# some of them don't have one: indexes created before `hash` was sortable only get the column
+	# once they're rebuilt, and documents still held in memory by the writer never have it.
+	def _hash_column(self, searcher):
+		if self._open_writer and self._open_writer.bufferedcount: return None
+
+		reader = searcher.reader()
+		if not all(leaf.has_column('hash') for leaf, _ in reader.leaf_readers()): return None
+
+		return reader.column_reader('hash')
+
+	# Returns the number of files matching the given query, without scoring or loading any of them.
+	def count(self, query_text):
+		return sum(1 for _ in self._searcher().docs_for_query(self._parse_query(query_text)))
+
+	# Counts the files matching the given query by each value of the given field. Keyword and text
+	# fields are counted by each word they contain, and files without the field are left out.
+	def facet(self, query_text, field):
+		field = self._resolve_field(field)
+		q = query.And([self._parse_query(query_text), query.Every(field)])
+
+		overlapping = isinstance(self._schema()[field], (fields.KEYWORD, fields.TEXT))
+		self._flush_for_sorting()
+		results = self._searcher().search(
+			q,
+			groupedby = sorting.FieldFacet(field, allow_overlap = overlapping),
+			maptype = sorting.Count,
+			scored = False,
+			limit = 1,
+		)
+
+		return results.groups()
 
 	# Deletes all the metadata for the given file.
 	def delete(self, f):
 		writer = self._writer()
+		self._session_stale = True
 		writer.delete_by_term('hash', f.hash)
 
 	# Saves the metadata for the given `File` to the database.
 	def save(self, f):
 		writer = self._writer()
+		self._session_stale = True
 
 		# We only add new fields when they are actually used, so they can be reconfigured up until
 		# that point.
@@ -227,5 +845,7 @@ class SearchDatabase:
 					raise common.FieldDoesNotExistError(field)
 
 				writer.add_field(field, self.configured_fields[field])
+				self._invalidate_parser()
 
 		writer.update_document(**f.metadata)
+		self._spill_if_needed()
@@ -0,0 +1,65 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+## Imports
+from qualia import config, conversion, database
+
+import pytest
+
+## Fixtures
+# Returns a function that creates a new database with the given hash scheme, set up the same way
+# `qualia.main` does when there is no config file otherwise.
+@pytest.fixture
+def new_db(tmp_path):
+	dbs = []
+
+	def new_db(name, hash_scheme):
+		config.conf = config.load_value({}, config.CONF_BASE)
+		config.conf['hash-scheme'] = hash_scheme
+
+		db = database.Database(str(tmp_path / name))
+		dbs.append(db)
+		return db
+
+	yield new_db
+
+	for db in dbs: db.close()
+
+## Tests
+# Metadata is matched to each imported file by the hash it was exported under, so it survives being
+# imported into a database that uses a different hash scheme.
+def test_import_other_hash_scheme(new_db, tmp_path):
+	source_filename = tmp_path / 'source'
+	source_filename.write_text('some file\n')
+
+	exporting = new_db('exporting', 'sha512')
+	f = exporting.add(str(source_filename))
+	f.set_metadata('tags', 'exported')
+	exporting.save(f)
+	exporting.commit()
+
+	with open(str(tmp_path / 'export.qualia'), 'wb') as output_file:
+		conversion.export(exporting, output_file, None)
+
+	importing = new_db('importing', 'blake2b-256')
+
+	with open(str(tmp_path / 'export.qualia'), 'rb') as input_file:
+		conversion.import_(importing, input_file)
+
+	[imported] = importing.all()
+	assert imported.hash != f.hash
+	assert imported.metadata['tags'] == 'exported'
@@ -0,0 +1,99 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+## Imports
+from qualia import config, conversion, database
+
+import gzip
+import os
+import pytest
+import threading
+
+## Fixtures
+# A new database, set up the same way `qualia.main` does when there is no config file.
+@pytest.fixture
+def db(tmp_path):
+	config.conf = config.load_value({}, config.CONF_BASE)
+
+	db = database.Database(str(tmp_path / 'db'))
+	yield db
+	db.close()
+
+## Utility functions
+# Returns a file object reading the given contents from a pipe, which can't be read at an offset and
+# has no size. The contents are written from another thread, so they can be larger than the pipe's
+# buffer.
+def _pipe(contents):
+	read_fd, write_fd = os.pipe()
+
+	def write():
+		with open(write_fd, 'wb') as f:
+			f.write(contents)
+
+	threading.Thread(target = write, daemon = True).start()
+
+	return open(read_fd, 'rb')
+
+## Tests
+# A file that can only be read through once is simply copied, rather than having its beginning read
+# for the duplicate check.
+def test_add_pipe(db):
+	contents = b'piped\n' * 100000
+
+	with _pipe(contents) as source_file:
+		f = db.add_file(source_file, link = 'copy')
+
+	hashobj = db.new_hash()
+	hashobj.update(contents)
+	assert f.hash == hashobj.hexdigest()
+
+	with db.open(f) as stored:
+		assert stored.read() == contents
+
+# Files that don't have a size of their own (a pipe, or a file in `/proc`, which claims to be empty)
+# are copied by reading them through, however they were asked to be linked.
+@pytest.mark.parametrize('link', ['auto', 'reflink'])
+def test_add_unsized(db, link):
+	contents = b'piped\n' * 100000
+
+	with _pipe(contents) as source_file:
+		f = db.add_file(source_file, link = link)
+
+	with db.open(f) as stored:
+		assert stored.read() == contents
+
+	with open('/proc/self/cmdline', 'rb') as source_file:
+		f = db.add_file(source_file, link = link)
+
+	with db.open(f) as stored, open('/proc/self/cmdline', 'rb') as source_file:
+		assert stored.read() == source_file.read() != b''
+
+# Files that are already compressed are stored as they are, rather than being compressed again.
+# This relies on their MIME type being that of the compressed file, not of what's inside it.
+def test_compressed_file_not_recompressed(db, tmp_path):
+	pytest.importorskip('magic')
+	config.conf['compression'] = 'zlib'
+
+	# (This isn't actually compressed, so it would be much smaller if it weren't skipped.)
+	source_filename = tmp_path / 'source.gz'
+	with gzip.open(str(source_filename), 'wb', compresslevel = 0) as f:
+		f.write(b'compressed\n' * 100000)
+
+	assert conversion.detect_mime_type(str(source_filename)) in database.INCOMPRESSIBLE_MIME_TYPES
+
+	f = db.add(str(source_filename))
+	assert db._stored_filename(f.hash)[1] is None
@@ -0,0 +1,82 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+## Imports
+from qualia import journal
+
+import datetime
+import pickle
+import pytest
+
+## Fixtures
+@pytest.fixture
+def j(tmp_path):
+	j = journal.Journal(str(tmp_path / 'journal'))
+	yield j
+	j.db.close()
+
+## Tests
+# Every lookup the journal makes while adding or restoring metadata has to use an index, or it slows
+# down as the journal grows. This is checked on a new journal, which has been through all of the
+# migrations in `Journal.upgrade_if_needed`.
+def test_query_plans_use_indexes(j):
+	for name, plan, uses_indexes in j.query_plans():
+		assert uses_indexes, '{}: {}'.format(name, '; '.join(plan))
+
+# Only the `set`s that are superseded are discarded by `compact`; the latest one of each field is
+# kept in the snapshot, and the checkpoints it came from are marked as compacted.
+def test_compact(j):
+	j.append('user', 'file', 'add')
+	j.append('user', 'file', 'set', 'tags', None, 'a')
+	j.append('user', 'file', 'set', 'tags', 'a', 'b')
+	first = j.commit()
+	j.append('user', 'file', 'set', 'tags', 'b', 'c')
+	second = j.commit()
+	j.append('user', 'file', 'set', 'tags', 'c', 'd')
+	third = j.commit()
+
+	assert j.compact(third) == 2
+	assert [t['extra'] for t in j.get_transactions('file', 'set')] == [('tags', 'b', 'c'), ('tags', 'c', 'd')]
+	assert list(j.checkpoint_summaries()) == [
+		(first, {'add': 1}, True),
+		(second, {}, True),
+		(third, {'set': 1}, False),
+	]
+
+# Transactions pickled before the typed columns existed are converted by `migrate_extra`, and read
+# back the same before and after; anything that can't be stored in the columns stays pickled.
+def test_migrate_extra(j):
+	now = datetime.datetime.now()
+	extras = [
+		(),
+		('imported-at', None, now),
+		('filename', None, 'caf\udce9.jpg'),
+		('size', 2 ** 70, True),
+		('other', None, {'a': 1}),
+	]
+
+	with j.db:
+		j.db.executemany(
+			'INSERT INTO journal(timestamp, source, file, op, extra) VALUES(?, ?, ?, ?, ?)',
+			((now, 'user', 'file', 'set' if extra else 'add', pickle.dumps(extra)) for extra in extras)
+		)
+		j.db.execute('UPDATE extra_migration SET until = (SELECT MAX(serial) FROM journal)')
+
+	assert [t['extra'] for t in j.get_transactions('file', 'set')] == extras[1:]
+	assert list(j.migrate_extra(batch_size = 2)) == [2, 4, 5]
+	assert [t['extra'] for t in j.get_transactions('file', 'set')] == extras[1:]
+	assert [row[0] is None for row in j.db.execute('SELECT extra FROM journal ORDER BY serial')] == [True] * 4 + [False]
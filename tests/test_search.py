@@ -0,0 +1,121 @@
+# Copyright (c) 2015 Jesse Weaver.
+#
+# This file is part of Qualia.
+#
+# Qualia is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qualia is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qualia. If not, see <http://www.gnu.org/licenses/>.
+
+## Imports
+from qualia import common, config, database
+
+import datetime
+import pytest
+
+## Fixtures
+# A new database, set up the same way `qualia.main` does when there is no config file.
+@pytest.fixture
+def db(tmp_path):
+	config.conf = config.load_value({}, config.CONF_BASE)
+
+	db = database.Database(str(tmp_path / 'db'))
+	yield db
+	db.close()
+
+## Utility functions
+# Adds `count` small files (numbered from `first`) to the given database, each with the given tags
+# and a distinct `imported-at`, and returns their hashes in the order they were added.
+def _add_files(db, directory, count, tags, first = 0):
+	start = datetime.datetime(2015, 1, 1)
+	hashes = []
+
+	for i in range(first, first + count):
+		source_filename = directory / 'source-{}'.format(i)
+		source_filename.write_text('file {}\n'.format(i))
+
+		with open(str(source_filename), 'rb') as source_file:
+			f = db.add_file(source_file)
+
+		f.set_metadata('imported-at', start + datetime.timedelta(days = i), 'auto')
+		f.set_metadata('tags', tags)
+		db.save(f)
+		hashes.append(f.hash)
+
+	return hashes
+
+## Tests
+# Sorting and faceting have to work before a new database is first committed, when all of its
+# documents are still held in memory by the search index's writer.
+def test_sort_uncommitted(db, tmp_path):
+	hashes = _add_files(db, tmp_path, 3, 'checked')
+
+	assert [result['hash'] for result in db.searchdb.search('tags:checked', None, sort = 'imported-at', reverse = True)] == hashes[::-1]
+
+def test_facet_uncommitted(db, tmp_path):
+	hashes = _add_files(db, tmp_path, 3, 'checked')
+
+	assert db.searchdb.facet('tags:checked', 'tags') == {'checked': len(hashes)}
+
+# A searcher replaced after a change is closed, unless a generator is still reading from it.
+def test_replaced_searcher_closed(db, tmp_path):
+	_add_files(db, tmp_path, 2, 'checked')
+	db.commit()
+
+	first = db.searchdb._searcher()
+	results = db.searchdb.all()
+	next(results)
+
+	_add_files(db, tmp_path, 1, 'checked', first = 2)
+	db.commit()
+
+	assert db.searchdb._searcher() is not first
+	assert not first.reader().is_closed
+
+	assert len(list(results)) == 1
+	assert first.reader().is_closed
+
+# Continuing from the cursor of the last result of each page goes through every result once, in
+# the same order as a single search. (There are enough results that the hits after the cursor have
+# to be trimmed down while the first pages are collected.)
+@pytest.mark.parametrize('sort, reverse', [(None, False), ('imported-at', False), ('imported-at', True)])
+def test_cursor_pages(db, tmp_path, sort, reverse):
+	_add_files(db, tmp_path, 9, 'checked')
+	db.commit()
+
+	expected = [f.hash for f in db.search('tags:checked', 10, sort = sort, reverse = reverse)]
+	results = []
+	cursor = None
+
+	while True:
+		page = list(db.search('tags:checked', 2, after = cursor, sort = sort, reverse = reverse))
+		if not page: break
+
+		results.extend(f.hash for f in page)
+		cursor = page[-1].cursor
+
+	assert results == expected
+
+def test_cursor_rejected_after_change(db, tmp_path):
+	_add_files(db, tmp_path, 3, 'checked')
+	db.commit()
+
+	cursor = list(db.search('tags:checked', 2))[-1].cursor
+
+	_add_files(db, tmp_path, 1, 'checked', first = 3)
+	db.commit()
+
+	with pytest.raises(common.InvalidCursorError):
+		list(db.search('tags:checked', 2, after = cursor))
+
+def test_unlimited_pages_rejected(db):
+	with pytest.raises(ValueError):
+		list(db.search('tags:checked', 0, page = 3))